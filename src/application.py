@@ -21,11 +21,15 @@ gi.require_version('Gdk', '3.0')
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gdk, Gio, Gtk
 
+from recovery import find_journals, recover
 from window import Window
 
+import gettext
 import logging
+import os
 
 
+_ = lambda a: gettext.dgettext(package.get_domain(), a)
 logger = logging.getLogger(__name__)
 
 
@@ -36,12 +40,53 @@ class Application(Gtk.Application):
                          flags=Gio.ApplicationFlags.HANDLES_OPEN,
                          **kwargs)
         self.cursor = None
+        self.recovered = False
+
+    def _recover(self):
+        # Offers to recover the images left unsaved by a crash once. Returns
+        # True if any image has been recovered.
+        if self.recovered:
+            return False
+        self.recovered = True
+        journals = []
+        for path in find_journals():
+            try:
+                buffer, file = recover(path)
+            except (OSError, ValueError) as e:
+                logger.error("%s: %s", path, e)
+                buffer = None
+            if buffer:
+                journals.append((path, buffer, file))
+            else:
+                os.remove(path)
+        if not journals:
+            return False
+        dialog = Gtk.MessageDialog(
+            None, 0, Gtk.MessageType.QUESTION,
+            Gtk.ButtonsType.NONE, _("Recover unsaved images?"))
+        dialog.format_secondary_text(
+            _("Paint was closed unexpectedly. %d image(s) can be recovered.") % len(journals))
+        dialog.add_buttons(_("Discard"), Gtk.ResponseType.REJECT,
+                           _("Recover"), Gtk.ResponseType.ACCEPT)
+        response = dialog.run()
+        dialog.destroy()
+        for path, buffer, file in journals:
+            if response == Gtk.ResponseType.ACCEPT:
+                win = Window(self, file=file, buffer=buffer,
+                             transparent_mode=buffer.get_transparent_mode(), journal=path)
+                win.show_all()
+            else:
+                os.remove(path)
+        return response == Gtk.ResponseType.ACCEPT
 
     def do_activate(self):
+        if self._recover():
+            return
         win = Window(self)
         win.show_all()
 
     def do_open(self, files, *hint):
+        self._recover()
         for file in files:
             win = self.is_opened(file)
             if win:
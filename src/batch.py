@@ -0,0 +1,187 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import package
+
+import gi
+gi.require_version('Gdk', '3.0')
+from gi.repository import Gdk
+
+from codec import find_codec, get_codecs
+from paint import TOOLS, PaintBuffer
+
+import argparse
+import concurrent.futures
+import cv2
+import gettext
+import json
+import logging
+import os
+import sys
+import time
+
+
+_ = lambda a: gettext.dgettext(package.get_domain(), a)
+logger = logging.getLogger(__name__)
+
+# The tools which can be scripted. An operation is a JSON object like
+#
+#   {"tool": "line", "points": [[10, 10], [200, 80]], "color": [1, 0, 0], "width": 4}
+#
+# where points are the pointer positions from the press to the release.
+# The other keys are optional: "color" as [red, green, blue] or
+# [red, green, blue, alpha] from 0 to 1, "width", "antialias", "shift" to
+# constrain shapes as with the Shift key, "font" and "text" for text, and
+# "tolerance" and "connectivity" for flood fills.
+BATCH_TOOLS = ('pencil', 'eraser', 'line', 'rectangle', 'oval', 'text', 'floodfill')
+
+# The operations applied by each worker process, and the default font
+operations = []
+font = ''
+
+
+class Event:
+    # A pointer event given to the tools
+    def __init__(self, state=0):
+        self.state = state
+        self.button = 1
+
+
+class View:
+    # Stands in for PaintView to drive the tools without a display.
+    def __init__(self, buffer, font):
+        self.buffer = buffer
+        self.font = font
+
+    def get_font(self):
+        return self.font
+
+    def reset(self):
+        pass
+
+
+def apply_operation(view, operation):
+    # Draws an operation onto view.buffer.
+    tool = TOOLS[operation['tool']](view)
+    tool.set_antialias(operation.get('antialias', True))
+    tool.set_color(*operation.get('color', (0, 0, 0)))
+    tool.set_line_width(operation.get('width', 1))
+    tool.set_fill_mode(operation.get('tolerance', 0), operation.get('connectivity', 4))
+    tool.set_font(operation.get('font', view.font))
+    event = Event(Gdk.ModifierType.SHIFT_MASK if operation.get('shift') else 0)
+    # The press and the release are at whole pixels as in PaintView.
+    points = [tuple(point) for point in operation['points']]
+    tool.on_mouse_press(view, event, round(points[0][0]), round(points[0][1]))
+    if tool.is_text():
+        tool.insert_text(operation.get('text', ''))
+        tool.reflow(view)
+    else:
+        tool.on_mouse_motion(view, event, points[1:])
+    tool.on_mouse_release(view, event, round(points[-1][0]), round(points[-1][1]))
+    view.buffer.apply(tool)
+
+
+def load_operations(path):
+    with open(path) as f:
+        ops = json.load(f)
+    if not isinstance(ops, list):
+        raise ValueError(_("The operations must be a list"))
+    for op in ops:
+        if op.get('tool') not in BATCH_TOOLS:
+            raise ValueError(_("Unknown tool: %s") % op.get('tool'))
+        if not op.get('points'):
+            raise ValueError(_("No points for %s") % op['tool'])
+    return ops
+
+
+def _init_worker(ops):
+    global operations, font
+    operations = ops
+    font = package.get_document_font_name()
+    # One worker runs per core.
+    cv2.setNumThreads(1)
+
+
+def _process(job):
+    # Runs in a worker process; returns an error message, or ''.
+    src, dst = job
+    try:
+        codec = find_codec(os.path.basename(src)) or get_codecs()[0]
+        with open(src, 'rb') as f:
+            buffer = PaintBuffer.create_from_file(f, codec, history=False)
+        view = View(buffer, font)
+        for op in operations:
+            apply_operation(view, op)
+        codec = find_codec(os.path.basename(dst)) or get_codecs()[0]
+        options = {'threads': 1} if codec.get_extension() == 'png' else {}
+        with open(dst, 'wb') as f:
+            buffer.write(f, codec, **options)
+    except Exception as e:
+        return '%s: %s' % (src, e)
+    return ''
+
+
+def _list_jobs(src, dst, extension):
+    if os.path.isdir(src):
+        names = sorted(name for name in os.listdir(src)
+                       if find_codec(name) and os.path.isfile(os.path.join(src, name)))
+        sources = [os.path.join(src, name) for name in names]
+    else:
+        sources = [src]
+    jobs = []
+    for path in sources:
+        name = os.path.basename(path)
+        if extension:
+            name = os.path.splitext(name)[0] + '.' + extension
+        jobs.append((path, os.path.join(dst, name)))
+    return jobs
+
+
+def main(args):
+    # esrille-paint --batch ops.json in/ out/
+    parser = argparse.ArgumentParser(prog='esrille-paint --batch',
+                                     description=_("Apply the operations to the images without a display."))
+    parser.add_argument('operations', help=_("JSON file of the operations"))
+    parser.add_argument('input', help=_("image file or directory"))
+    parser.add_argument('output', help=_("output directory"))
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help=_("number of worker processes"))
+    parser.add_argument('-f', '--format', help=_("file extension of the output images"))
+    args = parser.parse_args(args)
+    try:
+        ops = load_operations(args.operations)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 2
+    if args.format and not find_codec('.' + args.format):
+        print(_("Unsupported format: %s") % args.format, file=sys.stderr)
+        return 2
+    jobs = _list_jobs(args.input, args.output, args.format)
+    os.makedirs(args.output, exist_ok=True)
+
+    failed = 0
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.jobs),
+                                                initializer=_init_worker, initargs=(ops,)) as executor:
+        chunksize = max(1, len(jobs) // (4 * max(1, args.jobs)))
+        for message in executor.map(_process, jobs, chunksize=chunksize):
+            if message:
+                print(message, file=sys.stderr)
+                failed += 1
+    elapsed = time.perf_counter() - start
+    done = len(jobs) - failed
+    print(_("%d images in %.2f sec, %.1f images/sec") % (done, elapsed, done / elapsed if elapsed else 0))
+    return 1 if failed else 0
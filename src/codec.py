@@ -0,0 +1,346 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import package
+
+import cairo
+import concurrent.futures
+import cv2
+import gettext
+import logging
+import numpy
+import os
+import struct
+import zlib
+
+
+_ = lambda a: gettext.dgettext(package.get_domain(), a)
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUALITY = 90
+DEFAULT_COMPRESSION = 6     # zlib level, as cairo writes PNG files
+
+# PNG row filters
+FILTER_NONE = 0
+FILTER_SUB = 1
+FILTER_UP = 2
+FILTER_AVERAGE = 3
+FILTER_PAETH = 4
+FILTER_ADAPTIVE = 5     # the filter of the smallest sum of differences for each row
+
+PNG_BAND = 2 * 1024 * 1024  # bytes of rows deflated together in a thread
+PNG_WINDOW = 32 * 1024      # the deflate window primed from the previous band
+
+# Options used for fast saving
+FAST_SAVE = {'compression': 1, 'filter_type': FILTER_UP}
+
+
+def _get_bgra(surface):
+    # Returns the pixels of a cairo.FORMAT_ARGB32 surface as a numpy array
+    # of shape (height, width, 4) sharing the memory of surface.
+    surface.flush()
+    return numpy.ndarray(shape=(surface.get_height(), surface.get_width(), 4), dtype=numpy.uint8,
+                         buffer=surface.get_data(), strides=(surface.get_stride(), 4, 1))
+
+
+def premultiply(image):
+    # Returns a new cairo.FORMAT_ARGB32 surface from a BGRA image of cv2.
+    height, width = image.shape[:2]
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    pixels = _get_bgra(surface)
+    alpha = image[..., 3:].astype(numpy.uint16)
+    pixels[..., :3] = (image[..., :3] * alpha + 127) // 255
+    pixels[..., 3:] = alpha
+    surface.mark_dirty()
+    return surface
+
+
+def unpremultiply(surface):
+    # Returns the pixels of a cairo.FORMAT_ARGB32 surface as a new BGRA
+    # image of cv2.
+    pixels = _get_bgra(surface)
+    image = pixels.copy()
+    alpha = pixels[..., 3:].astype(numpy.uint16)
+    translucent = (0 < alpha[..., 0]) & (alpha[..., 0] < 255)
+    if translucent.any():
+        a = alpha[translucent]
+        image[translucent, :3] = (pixels[translucent, :3].astype(numpy.uint16) * 255 + a // 2) // a
+    return image
+
+
+def _filter_rows(rows, prev, bpp, strategy):
+    # Returns rows filtered for PNG with a filter type byte at the head of
+    # each row. prev is the row before rows, or zeros.
+    up = numpy.concatenate((prev[numpy.newaxis], rows[:-1]))
+    left = numpy.zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+    if strategy == FILTER_ADAPTIVE:
+        candidates = [_filter_rows(rows, prev, bpp, f) for f in range(FILTER_ADAPTIVE)]
+        # Choose the filter of the smallest sum of differences as signed bytes.
+        sums = numpy.stack([numpy.abs(c[:, 1:].view(numpy.int8).astype(numpy.int32)).sum(axis=1)
+                            for c in candidates])
+        best = sums.argmin(axis=0)
+        filtered = candidates[0]
+        for f in range(1, FILTER_ADAPTIVE):
+            filtered[best == f] = candidates[f][best == f]
+        return filtered
+    if strategy == FILTER_SUB:
+        data = rows - left
+    elif strategy == FILTER_UP:
+        data = rows - up
+    elif strategy == FILTER_AVERAGE:
+        data = rows - ((left.astype(numpy.uint16) + up) >> 1).astype(numpy.uint8)
+    elif strategy == FILTER_PAETH:
+        upper_left = numpy.zeros_like(rows)
+        upper_left[:, bpp:] = up[:, :-bpp]
+        a = left.astype(numpy.int16)
+        b = up.astype(numpy.int16)
+        c = upper_left.astype(numpy.int16)
+        pa = numpy.abs(b - c)
+        pb = numpy.abs(a - c)
+        pc = numpy.abs(a + b - 2 * c)
+        predictor = numpy.where((pa <= pb) & (pa <= pc), left, numpy.where(pb <= pc, up, upper_left))
+        data = rows - predictor
+    else:
+        data = rows
+    filtered = numpy.empty((rows.shape[0], rows.shape[1] + 1), dtype=numpy.uint8)
+    filtered[:, 0] = strategy
+    filtered[:, 1:] = data
+    return filtered
+
+
+def _deflate_band(image, start, stop, bpp, level, strategy, last):
+    # Deflates the rows of image from start to stop into raw deflate blocks
+    # that can be joined with the blocks of the other bands. Each band is
+    # primed with the window of the rows before it, as pigz does.
+    zero = numpy.zeros_like(image[0])
+    filtered = _filter_rows(image[start:stop], image[start - 1] if start else zero, bpp, strategy)
+    if start:
+        count = min(start, -(-PNG_WINDOW // (image.shape[1] + 1)))
+        before = image[start - count - 1] if count < start else zero
+        zdict = _filter_rows(image[start - count:start], before, bpp, strategy).tobytes()[-PNG_WINDOW:]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = filtered.tobytes()
+    deflated = compressor.compress(data)
+    deflated += compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return deflated, zlib.adler32(data)
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)))
+
+
+def read_png(fobj):
+    # Reads a PNG file as a cairo.FORMAT_ARGB32 surface.
+    surface = cairo.ImageSurface.create_from_png(fobj)
+    if surface.get_format() == cairo.FORMAT_ARGB32:
+        return surface
+    copy = cairo.ImageSurface(cairo.FORMAT_ARGB32, surface.get_width(), surface.get_height())
+    cr = cairo.Context(copy)
+    cr.set_source_surface(surface)
+    cr.paint()
+    return copy
+
+
+def write_png(surface, fobj, compression=DEFAULT_COMPRESSION, filter_type=FILTER_ADAPTIVE, threads=None):
+    # Writes surface as a standard PNG file. Large images are filtered and
+    # deflated in bands of rows in parallel, and the bands are joined into
+    # a single zlib stream.
+    image = unpremultiply(surface)
+    height, width = image.shape[:2]
+    if (image[..., 3] == 255).all():
+        image = image[..., 2::-1]
+        color_type = 2
+    else:
+        image = image[..., [2, 1, 0, 3]]
+        color_type = 6
+    bpp = image.shape[2]
+    image = numpy.ascontiguousarray(image).reshape(height, width * bpp)
+    level = int(compression)
+    strategy = int(filter_type)
+
+    rows = max(1, PNG_BAND // max(1, width * bpp))
+    bands = [(start, min(height, start + rows)) for start in range(0, height, rows)]
+    if 1 < len(bands):
+        with concurrent.futures.ThreadPoolExecutor(threads or os.cpu_count()) as executor:
+            results = list(executor.map(
+                lambda band: _deflate_band(image, band[0], band[1], bpp, level, strategy,
+                                           band[1] == height),
+                bands))
+    else:
+        results = [_deflate_band(image, 0, height, bpp, level, strategy, True)]
+
+    # The zlib header for the level, the deflate blocks of the bands, and the
+    # adler32 of the whole stream combined from the bands.
+    data = [zlib.compressobj(level).flush()[:2]]
+    adler = 1
+    for (start, stop), (deflated, checksum) in zip(bands, results):
+        adler = _combine_adler32(adler, checksum, (stop - start) * (width * bpp + 1))
+        data.append(deflated)
+    data.append(struct.pack('>I', adler))
+
+    fobj.write(b'\x89PNG\r\n\x1a\n')
+    fobj.write(_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)))
+    for block in data:
+        if block:
+            fobj.write(_chunk(b'IDAT', block))
+    fobj.write(_chunk(b'IEND', b''))
+
+
+def _combine_adler32(adler1, adler2, length2):
+    # Returns the adler32 of two byte strings joined from their adler32s as
+    # adler32_combine() of zlib does.
+    base = 65521
+    rem = length2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = rem * sum1 % base
+    sum1 += (adler2 & 0xffff) + base - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + base - rem
+    sum1 %= base
+    sum2 %= base
+    return sum2 << 16 | sum1
+
+
+class Option:
+    # A setting of a codec offered in the save dialog; either an integer
+    # from lower to upper, or the index of one of choices.
+    def __init__(self, name, label, default, lower=0, upper=0, choices=()):
+        self.name = name
+        self.label = label
+        self.default = default
+        self.lower = lower
+        self.upper = upper
+        self.choices = choices
+
+
+class Codec:
+    # Reads and writes images of a format. options are the Options offered
+    # in the save dialog, which are passed to write() by name. A codec has
+    # read(fobj), which returns a cairo.FORMAT_ARGB32 surface, and
+    # write(surface, fobj, background_color, **options), which composites
+    # the images of the formats without alpha over background_color.
+    def __init__(self, name, mime_types, extensions, alpha=True, options=(), params=()):
+        self.name = name
+        self.mime_types = mime_types
+        self.extensions = extensions
+        self.alpha = alpha
+        self.options = options
+        self.params = params    # fixed parameters to the encoder
+
+    def get_extension(self):
+        return self.extensions[0]
+
+    def get_extensions(self):
+        return self.extensions
+
+    def get_mime_types(self):
+        return self.mime_types
+
+    def get_name(self):
+        return self.name
+
+    def get_options(self):
+        return self.options
+
+
+class PngCodec(Codec):
+    # Reads PNG files with cairo, and writes them with write_png().
+    def __init__(self):
+        super().__init__(_("PNG images"), ("image/png",), ("png",), options=(
+            Option('compression', _("Compression"), DEFAULT_COMPRESSION, 0, 9),
+            Option('filter_type', _("Filter"), FILTER_ADAPTIVE,
+                   choices=(_("None"), _("Sub"), _("Up"), _("Average"), _("Paeth"), _("Adaptive")))))
+
+    def read(self, fobj):
+        return read_png(fobj)
+
+    def write(self, surface, fobj, background_color=(1, 1, 1), **options):
+        write_png(surface, fobj, **options)
+
+
+class CvCodec(Codec):
+    # Reads and writes images with cv2. options are keyed by the names of
+    # the cv2.IMWRITE_* constants.
+    def read(self, fobj):
+        data = numpy.frombuffer(fobj.read(), dtype=numpy.uint8)
+        image = cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise ValueError(_("Unsupported image data"))
+        if image.dtype == numpy.uint16:
+            image = (image >> 8).astype(numpy.uint8)
+        elif image.dtype != numpy.uint8:
+            image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGRA)
+        elif image.shape[2] == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+        return premultiply(image)
+
+    def write(self, surface, fobj, background_color=(1, 1, 1), **options):
+        image = unpremultiply(surface)
+        if not self.alpha:
+            # Composite over the background color
+            alpha = image[..., 3:].astype(numpy.uint16)
+            bgr = numpy.array([round(255 * i) for i in reversed(background_color)], dtype=numpy.uint16)
+            image = ((image[..., :3] * alpha + bgr * (255 - alpha) + 127) // 255).astype(numpy.uint8)
+        elif (image[..., 3] == 255).all():
+            image = image[..., :3]
+        params = list(self.params)
+        for name, value in options.items():
+            params += [getattr(cv2, name), int(value)]
+        ok, data = cv2.imencode('.' + self.get_extension(), image, params)
+        if not ok:
+            raise ValueError(_("Failed to encode image"))
+        fobj.write(data.data)
+
+
+codecs = [
+    PngCodec(),
+    CvCodec(_("JPEG images"), ("image/jpeg",), ("jpg", "jpeg", "jpe"), alpha=False,
+            options=(Option("IMWRITE_JPEG_QUALITY", _("Quality"), DEFAULT_QUALITY, 0, 100),)),
+    CvCodec(_("WebP images"), ("image/webp",), ("webp",),
+            options=(Option("IMWRITE_WEBP_QUALITY", _("Quality"), DEFAULT_QUALITY, 1, 100),)),
+    # Uncompressed TIFF is a fast lossless format for scratch work.
+    CvCodec(_("TIFF images"), ("image/tiff",), ("tif", "tiff"),
+            params=(cv2.IMWRITE_TIFF_COMPRESSION, 1)),
+]
+if cv2.haveImageWriter('.qoi'):
+    codecs.append(CvCodec(_("QOI images"), ("image/qoi", "image/x-qoi"), ("qoi",)))
+
+
+def find_codec(name=None, mime_type=None):
+    # Returns the codec for the extension of the file name or the MIME type,
+    # or None.
+    if name and '.' in name:
+        extension = name.rsplit('.', 1)[1].lower()
+        for codec in codecs:
+            if extension in codec.extensions:
+                return codec
+    if mime_type:
+        for codec in codecs:
+            if mime_type in codec.mime_types:
+                return codec
+    return None
+
+
+def get_codecs():
+    return codecs
+
+
+def register_codec(codec):
+    codecs.append(codec)
@@ -0,0 +1,191 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cairo
+import logging
+import tempfile
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+HISTORY_BUDGET = 256 * 1024 * 1024  # bytes kept in memory per document
+HISTORY_RAW = 64 * 1024 * 1024      # bytes of the latest surfaces kept uncompressed
+JOURNAL_SLACK = 64 * 1024 * 1024    # bytes of discarded entries left in the journal
+COMPRESSION_LEVEL = 1
+
+
+class Entry:
+    # A surface saved in HistoryStore. The surface is kept as it is,
+    # compressed in memory, or compressed in the journal file. A mapped
+    # surface is backed by a file and is always kept as it is.
+    def __init__(self, width, height, stride, transparent_mode, surface=None, mapped=False):
+        self.width = width
+        self.height = height
+        self.stride = stride
+        self.transparent_mode = transparent_mode
+        self.surface = surface
+        self.mapped = mapped
+        self.data = None        # compressed pixels
+        self.offset = -1        # offset of the compressed pixels in the journal
+        self.length = 0
+
+    def get_memory_size(self):
+        if self.mapped:
+            return 0
+        if self.surface is not None:
+            return self.stride * self.height
+        if self.data is not None:
+            return len(self.data)
+        return 0
+
+    def get_size(self):
+        return self.stride * self.height
+
+
+class HistoryStore:
+    # Keeps the surfaces saved for undo and redo within a memory budget.
+    # Older surfaces are compressed, and once the budget is exceeded the
+    # oldest ones are moved to a temporary journal file and read back when
+    # they are needed again. The space of the discarded entries in the
+    # journal is reclaimed once it exceeds slack and half of the journal.
+    def __init__(self, budget=HISTORY_BUDGET, raw=HISTORY_RAW, slack=JOURNAL_SLACK):
+        self.budget = budget
+        self.raw = raw
+        self.slack = slack
+        self.entries = {}       # in the order they have been put
+        self.journal = None
+        self.journal_size = 0
+        self.journal_free = 0   # bytes of the discarded entries in the journal
+
+    def _compact(self):
+        # Copies the entries in the journal to a new one.
+        journal = tempfile.TemporaryFile(prefix='esrille-paint-')
+        for entry in self.entries:
+            if entry.offset < 0:
+                continue
+            self.journal.seek(entry.offset)
+            data = self.journal.read(entry.length)
+            entry.offset = journal.tell()
+            journal.write(data)
+        self.journal.close()
+        self.journal = journal
+        self.journal_size = journal.tell()
+        self.journal_free = 0
+
+    def _compress(self, entry):
+        entry.surface.flush()
+        entry.data = zlib.compress(entry.surface.get_data(), COMPRESSION_LEVEL)
+        entry.surface = None
+
+    def _spill(self, entry):
+        if self.journal is None:
+            self.journal = tempfile.TemporaryFile(prefix='esrille-paint-')
+        self.journal.seek(0, 2)
+        entry.offset = self.journal.tell()
+        entry.length = len(entry.data)
+        self.journal.write(entry.data)
+        self.journal_size += entry.length
+        entry.data = None
+
+    def _trim(self):
+        raw = 0
+        for entry in reversed(list(self.entries)):
+            if entry.surface is None or entry.mapped:
+                continue
+            raw += entry.get_size()
+            if self.raw < raw:
+                self._compress(entry)
+        memory = self.get_memory_usage()
+        for entry in self.entries:
+            if memory <= self.budget:
+                break
+            if entry.data is not None:
+                memory -= entry.get_memory_size()
+                self._spill(entry)
+
+    def clear(self):
+        self.entries = {}
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.journal_size = 0
+        self.journal_free = 0
+
+    def discard(self, entry):
+        if entry is None or entry not in self.entries:
+            return
+        del self.entries[entry]
+        if entry.offset < 0:
+            return
+        self.journal_free += entry.length
+        if self.journal_free == self.journal_size:
+            self.journal.seek(0)
+            self.journal.truncate()
+            self.journal_size = 0
+            self.journal_free = 0
+        elif self.slack < self.journal_free and self.journal_size < 2 * self.journal_free:
+            self._compact()
+
+    def get(self, entry):
+        # Returns the saved surface, which must not be modified.
+        if entry.surface is not None:
+            return entry.surface
+        if entry.data is not None:
+            data = entry.data
+        else:
+            self.journal.seek(entry.offset)
+            data = self.journal.read(entry.length)
+        data = bytearray(zlib.decompress(data))
+        return cairo.ImageSurface.create_for_data(data, cairo.FORMAT_ARGB32,
+                                                  entry.width, entry.height, entry.stride)
+
+    def get_data(self, entry):
+        # Returns the compressed pixels of entry, or the surface if they are
+        # not compressed.
+        if entry.surface is not None:
+            return entry.surface
+        if entry.data is not None:
+            return entry.data
+        self.journal.seek(entry.offset)
+        return self.journal.read(entry.length)
+
+    def get_disk_usage(self):
+        return self.journal_size
+
+    def get_memory_usage(self):
+        return sum(entry.get_memory_size() for entry in self.entries)
+
+    def put(self, surface, transparent_mode=False, mapped=False):
+        # The surface must not be modified after it has been put.
+        entry = Entry(surface.get_width(), surface.get_height(), surface.get_stride(),
+                      transparent_mode, surface, mapped)
+        self.entries[entry] = None
+        self._trim()
+        return entry
+
+    def put_data(self, data, width, height, transparent_mode=False):
+        # Puts the pixels compressed by zlib.
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, width)
+        entry = Entry(width, height, stride, transparent_mode)
+        entry.data = data
+        self.entries[entry] = None
+        self._trim()
+        return entry
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self._trim()
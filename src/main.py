@@ -24,6 +24,8 @@ from gi.repository import Gdk, Gio, GLib, Gtk
 GLib.set_prgname(package.get_name())
 
 from application import Application
+from batch import main as batch_main
+from oplog import main as replay_main
 
 import gettext
 import locale
@@ -39,6 +41,14 @@ if __name__ == '__main__':
     except Exception:
         pass
     gettext.bindtextdomain(package.get_domain(), package.get_localedir())
+    if 2 <= len(sys.argv) and sys.argv[1] == '--batch':
+        # Process images without a display.
+        logging.basicConfig(level=logging.WARNING)
+        sys.exit(batch_main(sys.argv[2:]))
+    if 2 <= len(sys.argv) and sys.argv[1] == '--replay':
+        # Replay an operation log without a display.
+        logging.basicConfig(level=logging.WARNING)
+        sys.exit(replay_main(sys.argv[2:]))
     logging.basicConfig(level=logging.DEBUG)
 
     resource = Gio.Resource.load(os.path.join(package.get_datadir(), 'esrille-paint.gresource'))
@@ -0,0 +1,243 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import package
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf
+
+from batch import View
+from codec import FAST_SAVE, find_codec, get_codecs, write_png
+from paint import TOOLS, FloodFill, Lasso, Paste, PaintBuffer, Pencil, Restored, SelectionBase, Shape, Text
+
+import argparse
+import cairo
+import gettext
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+
+_ = lambda a: gettext.dgettext(package.get_domain(), a)
+logger = logging.getLogger(__name__)
+
+# An operation log is a text file of JSON objects, one per line. The first
+# line is the header, which refers to the canvas the log starts from; the
+# other lines are the operations committed to the PaintBuffer in order:
+#
+#   {"op": "append", "tool": "line", "color": [0, 0, 0, 1], "width": 1, "antialias": true,
+#    "rect": [10, 10, 190, 70]}
+#   {"op": "undo"}
+#
+# Images such as the canvas and pasted images are saved as PNG files named
+# after their SHA-1 in the payload directory next to the log.
+FORMAT = 'esrille-paint-oplog'
+VERSION = 1
+PAYLOAD_SUFFIX = '.payloads'
+
+
+def _dump_tool(tool, save_payload):
+    # Returns the state of a committed tool as a dict.
+    data = {
+        'tool': tool.get_name(),
+        'color': list(tool.color),
+        'width': tool.line_width,
+        'antialias': tool.antialias,
+    }
+    if isinstance(tool, Pencil):
+        data['stroke'] = [list(point) for point in tool.stroke]
+    elif isinstance(tool, Shape):
+        data['rect'] = [tool.x, tool.y, tool.width, tool.height]
+    elif isinstance(tool, FloodFill):
+        data['point'] = [tool.x, tool.y]
+        data['tolerance'] = tool.tolerance
+        data['connectivity'] = tool.connectivity
+    elif isinstance(tool, SelectionBase):
+        data['src'] = tool.src
+        data['dst'] = tool.dst
+        data['cut'] = tool.cut
+        if isinstance(tool, Lasso):
+            data['stroke'] = [list(point) for point in tool.stroke]
+        elif isinstance(tool, Text):
+            data['text'] = tool.text
+            data['font'] = tool.font
+        elif isinstance(tool, Paste):
+            data['payload'] = save_payload(tool.source)
+    elif isinstance(tool, Restored):
+        data['rect'] = list(tool.rect)
+        data['payload'] = save_payload(tool.source)
+    else:
+        raise ValueError(_("Unsupported tool: %s") % tool.get_name())
+    return data
+
+
+def _load_tool(data, view, load_payload):
+    # Creates the tool from its state returned by _dump_tool().
+    name = data['tool']
+    if name == 'paste':
+        tool = Paste(view, GdkPixbuf.Pixbuf.new_from_file(load_payload(data['payload'])))
+    elif name == 'restored':
+        tool = Restored(tuple(data['rect']), cairo.ImageSurface.create_from_png(load_payload(data['payload'])))
+    else:
+        tool = TOOLS[name](view)
+    tool.set_color(*data['color'])
+    tool.set_line_width(data['width'])
+    tool.set_antialias(data['antialias'])
+    if isinstance(tool, Pencil):
+        # Recompute the control points as the stroke is drawn.
+        stroke = [tuple(point) for point in data['stroke']]
+        tool.on_mouse_press(view, None, *stroke[0])
+        for x, y in stroke[1:]:
+            tool.on_mouse_move(view, None, x, y)
+    elif isinstance(tool, Shape):
+        tool.x, tool.y, tool.width, tool.height = data['rect']
+    elif isinstance(tool, FloodFill):
+        tool.x, tool.y = data['point']
+        tool.set_fill_mode(data['tolerance'], data['connectivity'])
+        tool.clicked = True
+    elif isinstance(tool, SelectionBase):
+        tool.src = [list(point) for point in data['src']]
+        tool.dst = [list(point) for point in data['dst']]
+        tool.cut = data['cut']
+        tool.closed = True
+        if isinstance(tool, Lasso):
+            tool.stroke = [tuple(point) for point in data['stroke']]
+        elif isinstance(tool, Text):
+            tool.text = data['text']
+            tool.current = len(tool.text)
+            tool.set_font(data['font'])
+    return tool
+
+
+class Recorder:
+    # Appends the operations committed to a PaintBuffer to an operation log
+    # as they are committed. See PaintBuffer.set_log().
+    def __init__(self, path, buffer):
+        self.path = path
+        self.payloads = path + PAYLOAD_SUFFIX
+        self.file = open(path, 'w', buffering=1)
+        self._write({
+            'format': FORMAT,
+            'version': VERSION,
+            'transparent_mode': buffer.get_transparent_mode(),
+            'background_color': list(buffer.get_background_color()),
+            'base': self._save_payload(buffer.get_surface()),
+        })
+
+    def _save_payload(self, surface):
+        # Saves surface as a PNG file, and returns its name.
+        fobj = io.BytesIO()
+        write_png(surface, fobj, **FAST_SAVE)
+        data = fobj.getvalue()
+        name = hashlib.sha1(data).hexdigest() + '.png'
+        path = os.path.join(self.payloads, name)
+        if not os.path.exists(path):
+            os.makedirs(self.payloads, exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        return name
+
+    def _write(self, data):
+        self.file.write(json.dumps(data, separators=(',', ':')) + '\n')
+
+    def append(self, tool):
+        data = {'op': 'append'}
+        data.update(_dump_tool(tool, self._save_payload))
+        self._write(data)
+
+    def close(self):
+        self.file.close()
+
+    def redo(self):
+        self._write({'op': 'redo'})
+
+    def set_background_color(self, rgb):
+        self._write({'op': 'background_color', 'value': list(rgb)})
+
+    def set_transparent_mode(self, mode):
+        self._write({'op': 'transparent_mode', 'value': mode})
+
+    def undo(self):
+        self._write({'op': 'undo'})
+
+
+def replay(path, buffer=None):
+    # Replays an operation log as fast as possible, and returns the
+    # PaintBuffer and the number of the operations. If buffer is None, the
+    # log is replayed from the canvas it has been recorded from.
+    payloads = path + PAYLOAD_SUFFIX
+
+    def load_payload(name):
+        return os.path.join(payloads, os.path.basename(name))
+
+    count = 0
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get('format') != FORMAT or VERSION < header.get('version', 0):
+            raise ValueError(_("Unsupported operation log"))
+        if buffer is None:
+            with open(load_payload(header['base']), 'rb') as png:
+                buffer = PaintBuffer.create_from_png(png)
+            buffer.set_background_color(tuple(header['background_color']))
+            buffer.set_transparent_mode(header['transparent_mode'])
+        view = View(buffer, package.get_document_font_name())
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            op = data['op']
+            if op == 'append':
+                buffer.append(_load_tool(data, view, load_payload))
+            elif op == 'undo':
+                buffer.do_undo()
+            elif op == 'redo':
+                buffer.do_redo()
+            elif op == 'transparent_mode':
+                buffer.set_transparent_mode(data['value'])
+            elif op == 'background_color':
+                buffer.set_background_color(tuple(data['value']))
+            else:
+                raise ValueError(_("Unknown operation: %s") % op)
+            count += 1
+    return buffer, count
+
+
+def main(args):
+    # esrille-paint --replay session.oplog [out.png]
+    parser = argparse.ArgumentParser(prog='esrille-paint --replay',
+                                     description=_("Replay an operation log without a display."))
+    parser.add_argument('log', help=_("operation log"))
+    parser.add_argument('output', nargs='?', help=_("image file to save the result"))
+    args = parser.parse_args(args)
+    start = time.perf_counter()
+    try:
+        buffer, count = replay(args.log)
+    except (OSError, ValueError, KeyError) as e:
+        print(e, file=sys.stderr)
+        return 2
+    elapsed = time.perf_counter() - start
+    print(_("%d operations in %.2f sec, %.1f operations/sec") %
+          (count, elapsed, count / elapsed if elapsed else 0))
+    if args.output:
+        codec = find_codec(os.path.basename(args.output)) or get_codecs()[0]
+        with open(args.output, 'wb') as f:
+            buffer.write(f, codec)
+    return 0
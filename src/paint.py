@@ -22,13 +22,19 @@ gi.require_version('Pango', '1.0')
 gi.require_version('PangoCairo', '1.0')
 from gi.repository import Gtk, Gdk, GdkPixbuf, GLib, GObject, Pango, PangoCairo
 
+from codec import read_png, write_png
+from history import HistoryStore
+from session import REDO, UNDO, Session, Snapshot
+
 import cairo
+import contextlib
 import copy
 import cv2
 import gettext
 import logging
 import math
 import numpy
+import threading
 import time
 
 
@@ -40,6 +46,89 @@ DEFAULT_HEIGHT = 600
 TEXT_MARGIN = 8
 RESIZE_BORDER = 16
 MARQUEE_COLOR = (0.8, 0.6, 0.1, 1)
+ANIMATION_INTERVAL = 200    # milliseconds between animation frames
+LAYER_MARGIN = 256  # pixels a stroke layer covers beyond the stroke when it grows
+FILL_TOLERANCE = 0  # the default difference of each channel filled together
+FILL_CONNECTIVITY = 4
+FILL_THREAD_LIMIT = 2048 * 2048   # pixels; fills on larger canvases run in a worker thread
+
+# Undo checkpoints
+CHECKPOINT_INTERVAL = 16    # operations between checkpoints
+CHECKPOINT_COST = 0.2       # seconds of replay between checkpoints
+CHECKPOINT_BUDGET = 256 * 1024 * 1024   # bytes
+
+# History modes
+HISTORY_REPLAY = 'replay'   # undo replays tools from a checkpoint
+HISTORY_DELTA = 'delta'     # undo restores the pixels each tool has changed
+
+# Pixels composited for display around the visible part of the canvas
+COMPOSITE_MARGIN = 256
+
+# Rows converted at a time between the transparent and opaque modes, which
+# bounds the size of the temporary arrays.
+CONVERT_ROWS = 256
+
+# Set True to check redo against a full replay of the history
+VERIFY_REDO = False
+
+
+def get_bounds(points, margin=0):
+    # Returns the bounding box of points as (x, y, width, height) in integers
+    left = math.floor(min(p[0] for p in points) - margin)
+    top = math.floor(min(p[1] for p in points) - margin)
+    right = math.ceil(max(p[0] for p in points) + margin)
+    bottom = math.ceil(max(p[1] for p in points) + margin)
+    return left, top, right - left, bottom - top
+
+
+def get_argb32(surface, rect=None):
+    # Returns the pixels of a cairo.FORMAT_ARGB32 surface within rect as a
+    # numpy array of uint32 of shape (height, width) sharing the memory of
+    # surface. None returns the whole surface.
+    surface.flush()
+    stride = surface.get_stride()
+    x, y, width, height = rect or (0, 0, surface.get_width(), surface.get_height())
+    return numpy.ndarray(shape=(height, width), dtype=numpy.uint32, buffer=surface.get_data(),
+                         offset=y * stride + 4 * x, strides=(stride, 4))
+
+
+def get_bgra(surface, rect=None):
+    # Returns the pixels of a cairo.FORMAT_ARGB32 surface within rect as a
+    # numpy array of uint8 of shape (height, width, 4) sharing the memory of
+    # surface. The channels are premultiplied and in the native byte order,
+    # i.e. BGRA on little endian machines. None returns the whole surface.
+    surface.flush()
+    stride = surface.get_stride()
+    x, y, width, height = rect or (0, 0, surface.get_width(), surface.get_height())
+    return numpy.ndarray(shape=(height, width, 4), dtype=numpy.uint8, buffer=surface.get_data(),
+                         offset=y * stride + 4 * x, strides=(stride, 4, 1))
+
+
+def get_clip_rect(cr):
+    x1, y1, x2, y2 = cr.clip_extents()
+    return get_bounds(((x1, y1), (x2, y2)))
+
+
+def union_rect(a, b):
+    if a[2] <= 0 or a[3] <= 0:
+        return b
+    if b[2] <= 0 or b[3] <= 0:
+        return a
+    left = min(a[0], b[0])
+    top = min(a[1], b[1])
+    right = max(a[0] + a[2], b[0] + b[2])
+    bottom = max(a[1] + a[3], b[1] + b[3])
+    return left, top, right - left, bottom - top
+
+
+def intersect_rect(a, b):
+    left = max(a[0], b[0])
+    top = max(a[1], b[1])
+    right = min(a[0] + a[2], b[0] + b[2])
+    bottom = min(a[1] + a[3], b[1] + b[3])
+    if right <= left or bottom <= top:
+        return None
+    return left, top, right - left, bottom - top
 
 
 class Tool:
@@ -68,6 +157,21 @@ class Tool:
     def get_cursor(self, view, x, y, pressed):
         return Gdk.CursorType.CROSS
 
+    def get_animation_rects(self, buffer):
+        # Returns the list of areas to be redrawn for the next animation
+        # frame. None in the list redraws the whole canvas.
+        return [self.get_extents(buffer)]
+
+    def get_damage(self, buffer):
+        # Returns the area on_draw() paints differently since the last frame,
+        # or None if the whole canvas needs to be redrawn.
+        return self.get_extents(buffer)
+
+    def get_extents(self, buffer):
+        # Returns the area on_draw() paints in buffer as (x, y, width, height),
+        # or None if the whole canvas could be changed.
+        return None
+
     def has_animation(self):
         return self.has_selection()
 
@@ -103,6 +207,12 @@ class Tool:
     def on_key_release(self, view, im, event):
         return False
 
+    def on_mouse_motion(self, view, event, points):
+        # Called once a frame with all the pointer positions since the last
+        # frame, in sub-pixel precision.
+        for x, y in points:
+            self.on_mouse_move(view, event, round(x), round(y))
+
     def on_mouse_move(self, view, event, x, y):
         return False
 
@@ -136,12 +246,23 @@ class Tool:
     def set_cursor_location(self, im, dx, dy):
         pass
 
+    def set_fill_mode(self, tolerance, connectivity):
+        pass
+
     def set_font(self, font):
         pass
 
     def set_line_width(self, width):
         self.line_width = width
 
+    def release(self, history):
+        # Discards the data moved to history by store().
+        pass
+
+    def store(self, history):
+        # Moves large data needed only for replaying this tool to history.
+        pass
+
 
 class Pencil(Tool):
 
@@ -149,6 +270,73 @@ class Pencil(Tool):
         super().__init__(view)
         self.stroke = []
         self.control_points = []
+        # The segments of the stroke that will not change are rendered once
+        # in the layer while the stroke is in progress. The layer covers
+        # layer_rect of the canvas and grows as the stroke extends.
+        self.layer = None
+        self.layer_rect = (0, 0, 0, 0)
+        self.layered = 1    # the first segment not rendered in the layer
+        self.reported = 0   # the length of the stroke at the last get_damage()
+
+    def _curve_to(self, cr, first, last):
+        # Adds the segments from first to last - 1 to the path, where the
+        # segment i ends at self.stroke[i].
+        length = len(self.stroke)
+        for i in range(first, last):
+            if i == 1:
+                # quadratic curve
+                cp1 = cp2 = self.control_points[0]
+            elif i == length - 1:
+                # quadratic curve
+                cp1 = cp2 = self.control_points[-1]
+            else:
+                # cubic curve
+                cp1 = self.control_points[i * 2 - 3]
+                cp2 = self.control_points[i * 2 - 2]
+            cr.curve_to(cp1[0], cp1[1], cp2[0], cp2[1], self.stroke[i][0], self.stroke[i][1])
+
+    def _draw_segments(self, cr, buffer, first, last):
+        cr.new_path()
+        cr.move_to(self.stroke[first - 1][0], self.stroke[first - 1][1])
+        self._curve_to(cr, first, last)
+        cr.stroke()
+
+    def _grow_layer(self, buffer, rect):
+        # Reallocates the layer to cover rect with a margin in proportion to
+        # its size, so that a long stroke reallocates it only a few times.
+        x, y, width, height = union_rect(self.layer_rect, rect) if self.layer else rect
+        dx = max(LAYER_MARGIN, width // 2)
+        dy = max(LAYER_MARGIN, height // 2)
+        canvas = (0, 0, buffer.get_width(), buffer.get_height())
+        rect = intersect_rect((x - dx, y - dy, width + 2 * dx, height + 2 * dy), canvas)
+        layer = buffer.get_surface().create_similar_image(cairo.FORMAT_ARGB32, rect[2], rect[3])
+        if self.layer is not None:
+            cr = cairo.Context(layer)
+            cr.set_operator(cairo.Operator.SOURCE)
+            cr.set_source_surface(self.layer, self.layer_rect[0] - rect[0], self.layer_rect[1] - rect[1])
+            cr.paint()
+        self.layer = layer
+        self.layer_rect = rect
+
+    def _update_layer(self, buffer):
+        # Only the last segment changes as the stroke extends.
+        final = len(self.stroke) - 1
+        if self.layer is None:
+            self.layered = 1
+        if final <= self.layered:
+            return
+        points = self.stroke[self.layered - 1:final]
+        points += self.control_points[max(0, 2 * self.layered - 3):2 * final - 2]
+        canvas = (0, 0, buffer.get_width(), buffer.get_height())
+        rect = intersect_rect(get_bounds(points, self._get_margin()), canvas)
+        if rect:
+            if self.layer is None or union_rect(self.layer_rect, rect) != self.layer_rect:
+                self._grow_layer(buffer, rect)
+            cr = cairo.Context(self.layer)
+            cr.translate(-self.layer_rect[0], -self.layer_rect[1])
+            Tool.on_draw(self, cr, buffer)
+            self._draw_segments(cr, buffer, self.layered, final)
+        self.layered = final
 
     @classmethod
     def get_name(cls):
@@ -157,6 +345,24 @@ class Pencil(Tool):
     def get_cursor(self, view, x, y, pressed):
         return Gdk.CursorType.BLANK_CURSOR if pressed else Gdk.CursorType.CROSS
 
+    def _get_margin(self):
+        return self.line_width / 2 + 1
+
+    def get_damage(self, buffer):
+        # The points added since the last call change the segments from the
+        # one ending at the last point reported; one more segment before it
+        # is included as the overlap.
+        first, self.reported = self.reported, len(self.stroke)
+        if first <= 3:
+            return self.get_extents(buffer)
+        return get_bounds(self.stroke[first - 3:] + self.control_points[2 * first - 7:], self._get_margin())
+
+    def get_extents(self, buffer):
+        if not self.stroke:
+            return 0, 0, 0, 0
+        # Bezier curves stay inside the convex hull of their control points.
+        return get_bounds(self.stroke + self.control_points, self._get_margin())
+
     def on_draw(self, cr, buffer):
         length = len(self.stroke)
         if length <= 0:
@@ -168,25 +374,26 @@ class Pencil(Tool):
                 cr.line_to(x, y)
             if length == 1:
                 cr.close_path()     # Draw a point
-        else:
+        elif buffer.appending:
+            # Draw the whole stroke at once to commit it.
+            self.layer = None
             cr.move_to(self.stroke[0][0], self.stroke[0][1])
-            # quadratic curve
-            cr.curve_to(self.control_points[0][0], self.control_points[0][1],
-                        self.control_points[0][0], self.control_points[0][1],
-                        self.stroke[1][0], self.stroke[1][1])
-
-            for i in range(2, length - 1):
-                # cubic curve
-                cr.curve_to(self.control_points[i * 2 - 3][0], self.control_points[i * 2 - 3][1],
-                            self.control_points[i * 2 - 2][0], self.control_points[i * 2 - 2][1],
-                            self.stroke[i][0], self.stroke[i][1])
-
-            # quadratic curve
-            cr.curve_to(self.control_points[-1][0], self.control_points[-1][1],
-                        self.control_points[-1][0], self.control_points[-1][1],
-                        self.stroke[-1][0], self.stroke[-1][1])
+            self._curve_to(cr, 1, length)
+        else:
+            self._update_layer(buffer)
+            if self.layer is not None:
+                cr.save()
+                cr.set_source_surface(self.layer, self.layer_rect[0], self.layer_rect[1])
+                cr.paint()
+                cr.restore()
+            cr.move_to(self.stroke[-2][0], self.stroke[-2][1])
+            self._curve_to(cr, length - 1, length)
         cr.stroke()
 
+    def on_mouse_motion(self, view, event, points):
+        for x, y in points:
+            self.on_mouse_move(view, event, x, y)
+
     def on_mouse_move(self, view, event, x, y):
         if self.stroke[-1][0] == x and self.stroke[-1][1] == y:
             return
@@ -214,6 +421,20 @@ class Eraser(Pencil):
     def get_cursor(self, view, x, y, pressed):
         return Gdk.CursorType.CROSS
 
+    def _get_margin(self):
+        # Square caps extend diagonally by half the line width times sqrt(2).
+        return 8 * self.line_width * 0.75 + 1
+
+    def _draw_segments(self, cr, buffer, first, last):
+        super()._draw_segments(cr, buffer, first, last)
+        buffer.set_source_rgba(cr)
+        cr.set_line_width(8 * self.line_width)
+        cr.set_line_cap(cairo.LineCap.SQUARE)
+        cr.new_path()
+        for x, y in self.stroke[first - 1:last]:
+            cr.line_to(x, y)
+        cr.stroke()
+
     def on_draw(self, cr, buffer):
         super().on_draw(cr, buffer)
         cr.set_operator(cairo.Operator.SOURCE)
@@ -221,7 +442,9 @@ class Eraser(Pencil):
         cr.set_line_width(8 * self.line_width)
         cr.set_line_cap(cairo.LineCap.SQUARE)
         cr.new_path()
-        for x, y in self.stroke:
+        # The layer has the segments before the last one while in progress.
+        first = 0 if buffer.appending or len(self.stroke) < 3 else len(self.stroke) - 2
+        for x, y in self.stroke[first:]:
             cr.line_to(x, y)
         cr.stroke()
         cr.set_operator(cairo.Operator.OVER)
@@ -239,6 +462,10 @@ class Shape(Tool):
     def get_name(cls):
         return 'shape'
 
+    def get_extents(self, buffer):
+        points = ((self.x, self.y), (self.x + self.width, self.y + self.height))
+        return get_bounds(points, self.line_width / 2 + 1)
+
     def on_draw(self, cr, buffer):
         super().on_draw(cr, buffer)
 
@@ -402,6 +629,16 @@ class SelectionBase(Tool):
                 return self.in_border(x, y, pressed)
         return Gdk.CursorType.CROSS
 
+    def get_animation_rects(self, buffer):
+        # The marquee around the destination rectangle
+        x, y, w, h = get_bounds(self.dst, 1)
+        return [(x, y, w, 2), (x, y + h - 2, w, 2), (x, y, 2, h), (x + w - 2, y, 2, h)]
+
+    def get_extents(self, buffer):
+        if not self.has_selection():
+            return get_bounds(self.src, 1)
+        return get_bounds(self.src + self.dst, 1)
+
     def get_offset(self):
         dx = self.dst[0][0] - self.src[0][0]
         dy = self.dst[0][1] - self.src[0][1]
@@ -605,6 +842,14 @@ class Lasso(SelectionBase):
     def get_name(cls):
         return 'lasso'
 
+    def get_animation_rects(self, buffer):
+        # The marquee along the transformed stroke, a few segments at a time
+        scale = self.get_scale()
+        points = [(self.dst[0][0] + (x - self.src[0][0]) * scale[0],
+                   self.dst[0][1] + (y - self.src[0][1]) * scale[1]) for x, y in self.stroke]
+        points.append(points[0])
+        return [get_bounds(points[i:i + 17], 1) for i in range(0, len(points) - 1, 16)]
+
     def on_mouse_move(self, view, event, x, y):
         if super().on_mouse_move(view, event, x, y):
             if x < self.src[0][0]:
@@ -705,14 +950,14 @@ class Text(SelectionBase):
                      w + TEXT_MARGIN, h + TEXT_MARGIN)
 
     def _draw_caret(self, cr, layout, text, current):
-        offset = int(time.time() * 10) % 10
-        if offset < 5:
-            return
         st, we = layout.get_cursor_pos(len(text[:current].encode()))
         self.caret.x = st.x / Pango.SCALE - 1
         self.caret.y = st.y / Pango.SCALE
         self.caret.width = st.width / Pango.SCALE + 2
         self.caret.height = st.height / Pango.SCALE
+        offset = int(time.time() * 10) % 10
+        if offset < 5:
+            return
         if (1, 13) <= cairo.version_info:
             cr.set_operator(cairo.Operator.DIFFERENCE)
             cr.set_source_rgb(1, 1, 1)
@@ -751,12 +996,29 @@ class Text(SelectionBase):
         self.current = 0
         return False
 
+    def get_animation_rects(self, buffer):
+        # The caret
+        scale = self.get_scale()
+        if scale[0] == 0 or scale[1] == 0:
+            scale = (1, 1)
+        x = self.dst[0][0] + self.caret.x * scale[0]
+        y = self.dst[0][1] + self.caret.y * scale[1]
+        points = ((x, y), (x + self.caret.width * scale[0], y + self.caret.height * scale[1]))
+        return [get_bounds(points, 1)]
+
     def get_cursor(self, view, x, y, pressed):
         cursor = super().get_cursor(view, x, y, pressed)
         if cursor == Gdk.CursorType.CROSS:
             return Gdk.CursorType.XTERM
         return cursor
 
+    def get_extents(self, buffer):
+        if self.text is None:
+            return 0, 0, 0, 0
+        # Glyphs may overhang the ink rectangle computed by reflow().
+        scale = max(self.get_scale() + (1,))
+        return get_bounds(self.dst, TEXT_MARGIN * scale)
+
     def has_animation(self):
         return self.text is not None
 
@@ -938,6 +1200,7 @@ class Paste(SelectionBase):
     def __init__(self, view, pixbuf: GdkPixbuf.Pixbuf):
         super().__init__(view)
         self.source = Gdk.cairo_surface_create_from_pixbuf(pixbuf, 0, None)
+        self.entry = None   # self.source saved in history
         self.closed = True
         self.src[1][0] = self.source.get_width()
         self.src[1][1] = self.source.get_height()
@@ -945,12 +1208,16 @@ class Paste(SelectionBase):
 
     def _create_path(self, cr):
         cr.new_path()
-        cr.rectangle(0, 0, self.source.get_width(), self.source.get_height())
+        w, h = self.get_size(self.src)
+        cr.rectangle(0, 0, w, h)
 
     @classmethod
     def get_name(cls):
         return 'paste'
 
+    def get_extents(self, buffer):
+        return get_bounds(self.dst, 1)
+
     def on_draw(self, cr, buffer):
         cr.set_line_width(1)
         cr.set_source_rgba(*self.color)
@@ -958,7 +1225,10 @@ class Paste(SelectionBase):
         self._transform(cr)
         self._create_path(cr)
         cr.clip()
-        cr.set_source_surface(self.source, 0, 0)
+        if self.source is not None:
+            cr.set_source_surface(self.source, 0, 0)
+        else:
+            cr.set_source_surface(buffer.history.get(self.entry), 0, 0)
         cr.paint()
         cr.restore()
         # Draw outline
@@ -970,6 +1240,15 @@ class Paste(SelectionBase):
             self._set_marquee(cr)
             cr.stroke()
 
+    def release(self, history):
+        history.discard(self.entry)
+        self.entry = None
+
+    def store(self, history):
+        if self.source is not None:
+            self.entry = history.put(self.source)
+            self.source = None
+
 
 class FloodFill(Tool):
     def __init__(self, view):
@@ -977,31 +1256,143 @@ class FloodFill(Tool):
         self.x = 0
         self.y = 0
         self.clicked = False
-
-    @classmethod
-    def get_name(cls):
-        return 'floodfill'
+        self.tolerance = FILL_TOLERANCE
+        self.connectivity = FILL_CONNECTIVITY
+        self.rect = None    # the bounding box of the filled pixels
+        self.mask = None    # the filled pixels within self.rect
+        self.bits = None    # self.mask packed into bits for replaying
+
+    def _get_fill_value(self, buffer):
+        # Returns the fill color as a pixel value of cairo.FORMAT_ARGB32
+        rgb = [round(255 * i) for i in self.color[:3]]
+        if buffer.get_transparent_mode() and rgb == [round(255 * i) for i in buffer.get_background_color()]:
+            return 0
+        return 0xff000000 | rgb[0] << 16 | rgb[1] << 8 | rgb[2]
+
+    def get_extents(self, buffer):
+        if not self.clicked:
+            return 0, 0, 0, 0
+        if self.rect is None:
+            self.search(buffer)
+        return self.rect
 
     def on_draw(self, cr, buffer):
         if not self.clicked:
             return
-        surface = buffer.make_opaque(buffer.get_surface())
-        buf = surface.get_data()
-        array = numpy.ndarray(shape=(surface.get_height(), surface.get_width(), 4),
-                              dtype=numpy.uint8, buffer=buf)
-        array = cv2.cvtColor(array, cv2.COLOR_RGBA2BGR)
-        color = [int(255 * i) for i in self.color[:3]]
-        cv2.floodFill(array, None, (self.x, self.y), color)
-        array = cv2.cvtColor(array, cv2.COLOR_BGR2RGBA)
-        surface = cairo.ImageSurface.create_for_data(array, cairo.FORMAT_ARGB32,
-                                                     surface.get_width(), surface.get_height())
-        buffer.set_surface(surface)
+        if self.mask is None:
+            if self.bits is not None:
+                # Replaying; the same pixels are filled again.
+                w, h = self.rect[2:]
+                self.mask = numpy.unpackbits(self.bits, count=w * h).reshape(h, w).view(bool)
+            else:
+                self.search(buffer)
+                if self.mask is None:
+                    return
+        with buffer.modify_pixels(self.rect) as pixels:
+            pixels.view(numpy.uint32)[..., 0][self.mask] = self._get_fill_value(buffer)
+        if self.bits is None:
+            self.bits = numpy.packbits(self.mask)
+        self.mask = None
 
     def on_mouse_release(self, view, event, x, y):
         self.x = x
         self.y = y
         self.clicked = True
 
+    def search(self, buffer, pixels=None):
+        # Finds the pixels to be filled without modifying the surface.
+        # pixels is a copy of buffer.get_pixels() to search instead of the
+        # surface, e.g., in a worker thread.
+        self.rect = (0, 0, 0, 0)
+        self.mask = None
+        if not (0 <= self.x < buffer.get_width() and 0 <= self.y < buffer.get_height()):
+            return
+        channels = buffer.get_pixels() if pixels is None else pixels
+        argb = channels.view(numpy.uint32)[..., 0]
+        seed = argb[self.y, self.x]
+        if seed == self._get_fill_value(buffer):
+            return
+        # Fill the connected pixels close to the seed color in a one byte per
+        # pixel image rather than converting the surface. The colors are
+        # compared as premultiplied ARGB, so that transparent pixels are
+        # treated as they are.
+        if self.tolerance <= 0:
+            image = (argb == seed).view(numpy.uint8)
+        else:
+            color = channels[self.y, self.x].astype(int)
+            image = cv2.inRange(channels,
+                                numpy.clip(color - self.tolerance, 0, 255),
+                                numpy.clip(color + self.tolerance, 0, 255))
+        count, image, mask, rect = cv2.floodFill(image, None, (self.x, self.y), 2,
+                                                 flags=self.connectivity)
+        x, y, w, h = rect
+        self.rect = (x, y, w, h)
+        self.mask = image[y:y + h, x:x + w] == 2
+
+    def set_fill_mode(self, tolerance, connectivity):
+        self.tolerance = tolerance
+        self.connectivity = connectivity
+
+
+# The tools by name
+TOOLS = {
+    "lasso": Lasso,
+    "selection": Selection,
+    "pencil": Pencil,
+    "eraser": Eraser,
+    "line": Line,
+    "rectangle": Rectangle,
+    "oval": Oval,
+    "text": Text,
+    "floodfill": FloodFill
+}
+
+
+class Restored(Tool):
+    # An edit restored from a session file, which is undone and redone with
+    # its Delta only, or the pixels changed by PaintBuffer.modify_pixels()
+    # outside of append(), which are drawn from source when replayed.
+    def __init__(self, rect, source=None):
+        super().__init__(None)
+        self.rect = rect
+        self.source = source    # the pixels within rect as cairo.ImageSurface
+        self.entry = None       # self.source saved in history
+
+    @classmethod
+    def get_name(cls):
+        return 'restored'
+
+    def get_extents(self, buffer):
+        return self.rect
+
+    def on_draw(self, cr, buffer):
+        if self.source is None and self.entry is None:
+            return
+        cr.set_operator(cairo.Operator.SOURCE)
+        if self.source is not None:
+            cr.set_source_surface(self.source, self.rect[0], self.rect[1])
+        else:
+            cr.set_source_surface(buffer.history.get(self.entry), self.rect[0], self.rect[1])
+        cr.rectangle(*self.rect)
+        cr.fill()
+
+    def release(self, history):
+        history.discard(self.entry)
+        self.entry = None
+
+    def store(self, history):
+        if self.source is not None:
+            self.entry = history.put(self.source)
+            self.source = None
+
+
+class Delta:
+    # The pixels in rect before and after a tool has been appended
+    def __init__(self, rect, before):
+        self.rect = rect
+        self.before = before    # history.Entry
+        self.after = None       # history.Entry
+
 
 class PaintBuffer(GObject.Object):
 
@@ -1011,26 +1402,82 @@ class PaintBuffer(GObject.Object):
         'undo': (GObject.SIGNAL_RUN_LAST, None, ())
     }
 
-    def __init__(self, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, fobj=None):
+    def __init__(self, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT, fobj=None, codec=None, session=None,
+                 history=True):
         super().__init__()
         self.background_color = (1, 1, 1)
         self.transparent_mode = False
-        if fobj:
-            self.surface = cairo.ImageSurface.create_from_png(fobj)
+        self.history_mode = HISTORY_DELTA
+        if session:
+            self.surface = session.map()
+            self.background_color = session.background_color
+            self.transparent_mode = session.transparent_mode
+        elif fobj and codec:
+            self.surface = codec.read(fobj)
+        elif fobj:
+            self.surface = read_png(fobj)
         else:
             self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
             cr = cairo.Context(self.surface)
             cr.set_source_rgba(*self.background_color, 1)
             cr.paint()
-        self.original = self._copy_surface(self.surface)
+        # Surfaces saved for undo and redo. A buffer without history can
+        # only apply() tools, e.g. in batch processing.
+        self.history = HistoryStore() if history else None
+        if not history:
+            self.original = None
+        elif session and session.native:
+            # Keep the mapped pixels rather than reading all of them.
+            self.original = self.history.put(session.map(True), self.transparent_mode, True)
+        else:
+            self.original = self._save(self._copy_surface(self.surface))
+        self.base_depth = 0     # the depth of the original surface in undo
+        self.saved_depth = 0    # the depth of the saved state in undo, or -1
         self.undo = []
         self.redo = []
+        self.generation = 0     # incremented each time the canvas is edited
         self.appending = False  # True during append()
+        # Snapshots of the surface taken while appending tools, so that undo
+        # and redo replay only the tools after the nearest checkpoint.
+        self.checkpoints = []   # list of (depth, history.Entry) sorted by depth
+        self.checkpoint_budget = CHECKPOINT_BUDGET
+        self.replay_cost = 0    # seconds spent in tools since the last checkpoint
+        # The pixels changed by each tool appended in HISTORY_DELTA mode
+        self.deltas = {}        # tool -> Delta
+        # The surface composited over the background color for display, the
+        # area of the canvas it covers, and the area of it to be updated.
+        self.composite = None
+        self.composite_rect = (0, 0, 0, 0)
+        self.damaged = None
+        self.dirty = None       # the area changed by modify_pixels() in append()
+        self.changed = None     # the area changed since the last take_changes()
+        self.unsaved = False    # True if the original surface has not been saved
+        # The session file the image has been read from or saved in, and the
+        # area changed since it was written.
+        self.session = session
+        self.unwritten = None
+        if session:
+            self._restore(session)
+        self.log = None     # oplog.Recorder of the committed operations
+        # The depths of undo and redo as the log has started
+        self.log_depth = 0
+        self.log_redo = 0
+
+    @classmethod
+    def create_from_file(cls, fobj, codec, history=True):
+        # Reads an image with a codec.Codec
+        return cls(None, None, fobj, codec, history=history)
 
     @classmethod
     def create_from_png(cls, fobj):
         return cls(None, None, fobj)
 
+    @classmethod
+    def create_from_session(cls, path):
+        # Opens a session file with its undo history. The pixels are read
+        # lazily as they are accessed.
+        return cls(None, None, session=Session(path))
+
     def _copy_surface(self, surface):
         copy = surface.create_similar_image(cairo.FORMAT_ARGB32, surface.get_width(), surface.get_height())
         cr = cairo.Context(copy)
@@ -1039,11 +1486,55 @@ class PaintBuffer(GObject.Object):
         cr.paint()
         return copy
 
-    def append(self, tool):
-        was_modified = self.get_modified()
+    def _add_checkpoint(self):
+        depth = len(self.undo)
+        self.replay_cost = 0
+        i = 0
+        while i < len(self.checkpoints) and self.checkpoints[i][0] < depth:
+            i += 1
+        if i < len(self.checkpoints) and self.checkpoints[i][0] == depth:
+            return
+        self.checkpoints.insert(i, (depth, self._save(self._copy_surface(self.surface))))
+        self._evict_checkpoints()
+
+    def _blit(self, rect, entry):
+        cr = cairo.Context(self.surface)
+        cr.set_operator(cairo.Operator.SOURCE)
+        cr.rectangle(*rect)
+        cr.clip()
+        cr.set_source_surface(self._load(entry), rect[0], rect[1])
+        cr.paint()
+        self._damage(rect)
+
+    def _copy_region(self, rect):
+        x, y, width, height = rect
+        copy = self.surface.create_similar_image(cairo.FORMAT_ARGB32, width, height)
+        cr = cairo.Context(copy)
+        cr.set_operator(cairo.Operator.SOURCE)
+        cr.set_source_surface(self.surface, -x, -y)
+        cr.paint()
+        return copy
+
+    def _damage(self, rect=None):
+        # Marks the area of the surface that has been changed. None marks the
+        # whole canvas.
+        canvas = (0, 0, self.get_width(), self.get_height())
+        rect = canvas if rect is None else intersect_rect(rect, canvas)
+        if rect:
+            self.damaged = rect if self.damaged is None else union_rect(self.damaged, rect)
+            self.changed = rect if self.changed is None else union_rect(self.changed, rect)
+            self.unwritten = rect if self.unwritten is None else union_rect(self.unwritten, rect)
+
+    def _discard(self, tool):
+        delta = self.deltas.pop(tool, None)
+        if delta:
+            self.history.discard(delta.before)
+            self.history.discard(delta.after)
+        tool.release(self.history)
+
+    def _draw(self, tool):
         self.appending = True
-        self.undo.append(tool)
-        self.redo.clear()
+        start = time.perf_counter()
         if not tool.is_selection():
             cr = cairo.Context(self.surface)
             tool.on_draw(cr, self)
@@ -1052,53 +1543,342 @@ class PaintBuffer(GObject.Object):
             cr_alt = cairo.Context(alt)
             tool.on_draw(cr_alt, self)
             self.surface = alt
+        self.replay_cost += time.perf_counter() - start
         self.appending = False
+        self._damage(tool.get_extents(self))
+
+    def _evict_checkpoints(self):
+        # Evict the oldest checkpoints to stay within the budget; the latest
+        # one is always kept.
+        while 1 < len(self.checkpoints) and self.checkpoint_budget < self.get_checkpoint_size():
+            depth, entry = self.checkpoints.pop(0)
+            self.history.discard(entry)
+
+    def _find_checkpoint(self, depth):
+        for checkpoint in reversed(self.checkpoints):
+            if checkpoint[0] <= depth:
+                return checkpoint
+        return self.base_depth, self.original
+
+    def _get_step(self, kind, tool):
+        delta = self.deltas[tool]
+        if not delta:
+            return kind, (0, 0, 0, 0), None, None
+        before = delta.before.transparent_mode, self.history.get_data(delta.before)
+        after = delta.after.transparent_mode, self.history.get_data(delta.after)
+        return kind, delta.rect, before, after
+
+    def _load(self, entry):
+        # Returns a surface saved in history, which must not be modified.
+        surface = self.history.get(entry)
+        if entry.transparent_mode != self.transparent_mode:
+            surface = self._copy_surface(surface)
+            surface = self.make_transparent(surface) if self.transparent_mode else self.make_opaque(surface)
+        return surface
+
+    def _save(self, surface):
+        # Saves surface in history. The surface must not be modified afterward.
+        return self.history.put(surface, self.transparent_mode)
+
+    def _update_composite(self, cr, window, area):
+        # Composites the surface over the background color around area,
+        # where it has been changed.
+        if self.composite is None or union_rect(self.composite_rect, area) != self.composite_rect:
+            x, y, width, height = area
+            canvas = (0, 0, self.get_width(), self.get_height())
+            rect = intersect_rect((x - COMPOSITE_MARGIN, y - COMPOSITE_MARGIN,
+                                   width + 2 * COMPOSITE_MARGIN, height + 2 * COMPOSITE_MARGIN), canvas)
+            if self.composite is None or self.composite_rect[2:] != rect[2:]:
+                if window:
+                    self.composite = window.create_similar_surface(cairo.Content.COLOR, rect[2], rect[3])
+                else:
+                    self.composite = cr.get_target().create_similar(cairo.Content.COLOR, rect[2], rect[3])
+            self.composite_rect = rect
+            self.damaged = rect
+        if self.damaged:
+            rect = intersect_rect(self.damaged, self.composite_rect)
+            self.damaged = None
+            if rect:
+                cr = cairo.Context(self.composite)
+                cr.translate(-self.composite_rect[0], -self.composite_rect[1])
+                cr.set_operator(cairo.Operator.SOURCE)
+                cr.rectangle(*rect)
+                cr.set_source_rgb(*self.background_color)
+                cr.fill_preserve()
+                cr.set_operator(cairo.Operator.OVER)
+                cr.set_source_surface(self.surface)
+                cr.fill()
+
+    def _update_checkpoints(self):
+        depth = len(self.undo)
+        if depth - self._find_checkpoint(depth)[0] >= CHECKPOINT_INTERVAL or CHECKPOINT_COST <= self.replay_cost:
+            self._add_checkpoint()
+
+    def _verify(self):
+        # Replays the whole history from the original surface without the
+        # checkpoints and compares the result with the current surface.
+        # Falls back to the replayed surface if they differ.
+        surface = self.surface
+        replay_cost = self.replay_cost
+        self.surface = self._copy_surface(self._load(self.original))
+        for tool in self.undo[self.base_depth:]:
+            self._draw(tool)
+        replayed, self.surface = self.surface, surface
+        self.replay_cost = replay_cost
+        surface.flush()
+        replayed.flush()
+        if bytes(surface.get_data()) == bytes(replayed.get_data()):
+            return True
+        logger.warning("surface does not match the replayed history")
+        self.surface = replayed
+        self._damage()
+        return False
+
+    def _reset_history(self):
+        # Makes the current surface the original one.
+        self.history.clear()
+        self.original = self._save(self._copy_surface(self.surface))
+        self.undo = []
+        self.redo = []
+        self.checkpoints = []
+        self.replay_cost = 0
+        self.deltas = {}
+        self.base_depth = 0
+        self.saved_depth = 0
+        self.log_depth = 0
+        self.log_redo = 0
+
+    def _restore(self, session):
+        # Restores the undo history saved in the session file; the original
+        # surface is the state after the restored edits.
+        for kind, rect, before, after in session.read_steps():
+            tool = Restored(rect)
+            delta = None
+            if rect[2] and rect[3]:
+                delta = Delta(rect, self.history.put_data(before[1], rect[2], rect[3], before[0]))
+                delta.after = self.history.put_data(after[1], rect[2], rect[3], after[0])
+            self.deltas[tool] = delta
+            if kind == UNDO:
+                self.undo.append(tool)
+            elif kind == REDO:
+                self.redo.append(tool)
+        self.base_depth = self.saved_depth = len(self.undo)
+
+    def _rebuild(self):
+        # Replay the tools after the nearest checkpoint
+        start = time.perf_counter()
+        undo = self.undo
+        depth, entry = self._find_checkpoint(len(undo))
+        self.surface = self._copy_surface(self._load(entry))
+        self._damage()
+        self.undo = undo[:depth]
+        self.replay_cost = 0
+        for tool in undo[depth:]:
+            self.undo.append(tool)
+            self._record(tool)
+        logger.debug("replayed %d of %d tools in %.3f sec",
+                     len(undo) - depth, len(undo), time.perf_counter() - start)
+
+    def _record(self, tool):
+        # Draws tool, which has been pushed onto undo, and keeps what is
+        # needed to undo it.
+        self.dirty = None
+        delta = self.deltas.pop(tool, None)
+        if delta:
+            # Replaying a tool
+            self.history.discard(delta.before)
+            self.history.discard(delta.after)
+            delta = None
+        if self.history_mode == HISTORY_DELTA:
+            rect = tool.get_extents(self)
+            canvas = (0, 0, self.get_width(), self.get_height())
+            rect = canvas if rect is None else intersect_rect(rect, canvas)
+            if rect:
+                delta = Delta(rect, self._save(self._copy_region(rect)))
+        self._draw(tool)
+        tool.store(self.history)
+        if self.history_mode == HISTORY_DELTA:
+            if self.dirty and (not delta or union_rect(delta.rect, self.dirty) != delta.rect):
+                logger.warning("%s changed pixels outside of its extents", tool.get_name())
+            if delta:
+                delta.after = self._save(self._copy_region(delta.rect))
+            self.deltas[tool] = delta
+        else:
+            self._update_checkpoints()
+
+    def append(self, tool):
+        if self.log:
+            self.log.append(tool)
+        was_modified = self.get_modified()
+        if len(self.undo) < self.saved_depth:
+            # The saved state is going to be discarded with redo.
+            self.saved_depth = -1
+        if len(self.undo) < self.base_depth:
+            # The restored edits are about to be replaced; replay from here.
+            self.history.discard(self.original)
+            self.original = self._save(self._copy_surface(self.surface))
+            self.base_depth = len(self.undo)
+        if self.redo:
+            # Checkpoints taken after the current state are for redo only.
+            depth = len(self.undo)
+            for checkpoint in self.checkpoints:
+                if depth < checkpoint[0]:
+                    self.history.discard(checkpoint[1])
+            self.checkpoints = [c for c in self.checkpoints if c[0] <= depth]
+            for redo in self.redo:
+                self._discard(redo)
+        self.undo.append(tool)
+        self.redo.clear()
+        self.log_redo = 0
+        self.generation += 1
+        self._record(tool)
         if not was_modified:
             self.set_modified(True)
 
+    def apply(self, tool):
+        # Draws tool without keeping it for undo, e.g. in batch processing.
+        self.generation += 1
+        self._draw(tool)
+
+    def detach_pixels(self):
+        # Continues editing on a copy of the surface, so that the pixels
+        # returned by get_pixels() so far are not modified, e.g., while a
+        # worker thread is reading them.
+        self.surface = self._copy_surface(self.surface)
+
     def do_redo(self):
-        if not self.redo:
+        if len(self.redo) <= (self.log_redo if self.log else 0):
             return
         logger.info("do_redo")
+        if self.log:
+            self.log.redo()
+        start = time.perf_counter()
+        was_modified = self.get_modified()
         tool = self.redo.pop()
         self.undo.append(tool)
-        redo, self.redo = self.redo, []
-        self.surface = self._copy_surface(self.original)
-        undo, self.undo = self.undo, []
-        for tool in undo:
-            self.append(tool)
-        self.redo = redo
+        self.generation += 1
+        if tool in self.deltas:
+            delta = self.deltas[tool]
+            if delta:
+                self._blit(delta.rect, delta.after)
+        else:
+            # The current surface is the state right before the tool.
+            self._draw(tool)
+            if VERIFY_REDO:
+                self._verify()
+            self._update_checkpoints()
+        logger.debug("redo in %.3f sec with %d tools in history",
+                     time.perf_counter() - start, len(self.undo))
+        if self.get_modified() != was_modified:
+            self.emit('modified-changed')
 
     def do_undo(self):
-        if not self.get_modified():
+        if len(self.undo) <= (self.log_depth if self.log else 0):
             return
         logger.info("do_undo")
+        if self.log:
+            self.log.undo()
+        was_modified = self.get_modified()
         tool = self.undo.pop()
         self.redo.append(tool)
-        redo, self.redo = self.redo, []
-        self.surface = self._copy_surface(self.original)
-        undo, self.undo = self.undo, []
-        for tool in undo:
-            self.append(tool)
-        self.redo = redo
-        if not self.get_modified():
+        self.generation += 1
+        if tool in self.deltas:
+            delta = self.deltas[tool]
+            if delta:
+                self._blit(delta.rect, delta.before)
+        else:
+            self._rebuild()
+        if self.get_modified() != was_modified:
             self.emit('modified-changed')
 
-    def draw(self, cr):
-        cr.rectangle(0, 0, self.get_width(), self.get_height())
-        cr.set_source_rgb(*self.background_color)
+    def draw(self, cr, window=None, viewport=None):
+        # Paint only the part of the canvas within the clip region, which is
+        # the visible part of the exposed area. The surface composited over
+        # the background color is kept only around viewport, the visible
+        # part of the canvas, and updated where the surface has been changed.
+        canvas = (0, 0, self.get_width(), self.get_height())
+        rect = intersect_rect(get_clip_rect(cr), canvas)
+        if not rect:
+            return
+        if viewport:
+            viewport = intersect_rect(viewport, canvas)
+        self._update_composite(cr, window, union_rect(viewport, rect) if viewport else rect)
+        cr.rectangle(*rect)
+        cr.set_source_surface(self.composite, self.composite_rect[0], self.composite_rect[1])
         cr.fill()
-        cr.set_source_surface(self.get_surface())
-        cr.paint()
 
     def get_background_color(self):
         return self.background_color
 
+    def get_checkpoint_budget(self):
+        return self.checkpoint_budget
+
+    def get_checkpoint_size(self):
+        return sum(entry.get_size() for depth, entry in self.checkpoints)
+
+    def get_generation(self):
+        return self.generation
+
     def get_height(self):
         return self.surface.get_height()
 
+    def get_history_mode(self):
+        return self.history_mode
+
+    def get_history_usage(self):
+        # Returns the bytes used for undo and redo in memory and on disk.
+        return self.history.get_memory_usage(), self.history.get_disk_usage()
+
+    def get_log(self):
+        return self.log
+
     def get_modified(self):
-        return 0 < len(self.undo)
+        return len(self.undo) != self.saved_depth or self.unsaved
+
+    def get_pixels(self, rect=None):
+        # Returns the pixels of the canvas within rect as a numpy array of
+        # shape (height, width, 4) sharing the memory of the surface; see
+        # get_bgra(). Use modify_pixels() to change them.
+        canvas = (0, 0, self.get_width(), self.get_height())
+        rect = canvas if rect is None else intersect_rect(rect, canvas) or (0, 0, 0, 0)
+        return get_bgra(self.surface, rect)
+
+    def get_session(self):
+        return self.session
+
+    def get_session_snapshot(self, path):
+        # Returns a session.Snapshot to save the image with the undo history
+        # that can be undone and redone with deltas. If path is the session
+        # file of the buffer, only the rows changed since it was written are
+        # written back.
+        width = self.get_width()
+        height = self.get_height()
+        start = len(self.undo)
+        while 0 < start and self.undo[start - 1] in self.deltas:
+            start -= 1
+        steps = [self._get_step(UNDO, tool) for tool in self.undo[start:]]
+        start = len(self.redo)
+        while 0 < start and self.redo[start - 1] in self.deltas:
+            start -= 1
+        steps += [self._get_step(REDO, tool) for tool in self.redo[start:]]
+        if self.session and self.session.path == path and self.session.is_writable(width, height):
+            start = stop = 0
+            if self.unwritten:
+                start = self.unwritten[1]
+                stop = start + self.unwritten[3]
+            self.surface.flush()
+            stride = self.surface.get_stride()
+            pixels = bytes(self.surface.get_data()[start * stride:stop * stride])
+        else:
+            start = None
+            pixels = self.get_snapshot()
+        self.unwritten = None
+        return Snapshot(width, height, pixels, self.transparent_mode, self.background_color, steps, start)
+
+    def get_snapshot(self):
+        # Returns a copy of the surface, which can be encoded in another
+        # thread while the canvas is edited.
+        return self._copy_surface(self.surface)
 
     def get_surface(self):
         return self.surface
@@ -1109,43 +1889,135 @@ class PaintBuffer(GObject.Object):
     def get_width(self):
         return self.surface.get_width()
 
+    @contextlib.contextmanager
+    def modify_pixels(self, rect=None):
+        # Yields the pixels within rect like get_pixels(), and marks them
+        # changed for cairo, history and display on exit.
+        canvas = (0, 0, self.get_width(), self.get_height())
+        rect = canvas if rect is None else intersect_rect(rect, canvas) or (0, 0, 0, 0)
+        if not self.appending and rect[2] and rect[3]:
+            # Outside of append(), the pixels are changed in a copy, which is
+            # appended as a Restored tool so that the change can be undone.
+            region = self._copy_region(rect)
+            yield get_bgra(region)
+            region.mark_dirty()
+            self.append(Restored(rect, region))
+            return
+        try:
+            yield get_bgra(self.surface, rect)
+        finally:
+            self.surface.mark_dirty_rectangle(*rect)
+            self._damage(rect)
+            if self.appending:
+                self.dirty = union_rect(self.dirty, rect) if self.dirty else rect
+
     def make_opaque(self, surface):
-        copy = cairo.ImageSurface(cairo.FORMAT_ARGB32, surface.get_width(), surface.get_height())
-        cr = cairo.Context(copy)
-        cr.set_source_rgba(*self.background_color, 1)
-        cr.paint()
-        cr.set_source_surface(surface)
-        cr.paint()
-        return copy
+        # Composites surface over the background color in place, and returns
+        # surface. A surface in another format is converted in a copy.
+        if surface.get_format() != cairo.FORMAT_ARGB32:
+            surface = self._copy_surface(surface)
+        pixels = get_argb32(surface)
+        rgb = [round(255 * i) for i in self.background_color]
+        for y in range(0, pixels.shape[0], CONVERT_ROWS):
+            rows = pixels[y:y + CONVERT_ROWS]
+            inverse = 255 - (rows >> 24)
+            opaque = numpy.full_like(rows, 0xff000000)
+            for shift, c in zip((16, 8, 0), rgb):
+                opaque |= ((rows >> shift & 0xff) + (c * inverse + 127) // 255) << shift
+            rows[...] = opaque
+        surface.mark_dirty()
+        return surface
 
     def make_transparent(self, surface):
-        pixbuf = Gdk.pixbuf_get_from_surface(self.surface, 0, 0,
-                                             surface.get_width(), surface.get_height())
-        rgb = [int(i * 255) for i in self.get_background_color()]
-        pixbuf = pixbuf.add_alpha(True, *rgb)
-        return Gdk.cairo_surface_create_from_pixbuf(pixbuf, 0, None)
+        # Clears the pixels of the background color in place as
+        # GdkPixbuf.Pixbuf.add_alpha() does, and returns surface. A surface in
+        # another format is converted in a copy.
+        if surface.get_format() != cairo.FORMAT_ARGB32:
+            surface = self._copy_surface(surface)
+        pixels = get_argb32(surface)
+        rgb = [round(255 * i) for i in self.background_color]
+        color = 0xff000000 | rgb[0] << 16 | rgb[1] << 8 | rgb[2]
+        for y in range(0, pixels.shape[0], CONVERT_ROWS):
+            rows = pixels[y:y + CONVERT_ROWS]
+            rows[rows == color] = 0
+            # Translucent pixels are compared unpremultiplied.
+            alpha = rows >> 24
+            translucent = (0 < alpha) & (alpha < 255)
+            if not translucent.any():
+                continue
+            values = rows[translucent]
+            alpha = values >> 24
+            match = numpy.ones(values.shape, dtype=bool)
+            for shift, c in zip((16, 8, 0), rgb):
+                match &= ((values >> shift & 0xff) * 255 + alpha // 2) // alpha == c
+            values[match] = 0
+            rows[translucent] = values
+        surface.mark_dirty()
+        return surface
 
     def set_background_color(self, rgb):
+        if self.log:
+            self.log.set_background_color(rgb)
         self.background_color = rgb
+        self.composite = None
+
+    def set_checkpoint_budget(self, budget):
+        self.checkpoint_budget = budget
+        self._evict_checkpoints()
+
+    def set_history_budget(self, budget):
+        self.history.set_budget(budget)
+
+    def set_history_mode(self, mode):
+        # Tools appended in another mode keep their own way of undoing.
+        self.history_mode = mode
 
     def set_modified(self, modified):
         if self.get_modified() and not modified:
-            self.original = self._copy_surface(self.surface)
-            self.undo = []
-            self.redo = []
+            if self.session:
+                # Keep the history, which has been saved in the session file.
+                self.saved_depth = len(self.undo)
+            else:
+                self._reset_history()
+            self.unsaved = False
         self.emit('modified-changed')
         return self.get_modified()
 
+    def set_unsaved(self):
+        # Makes the current surface, e.g. recovered after a crash, the
+        # original one, which has not been saved yet.
+        self._reset_history()
+        self.unsaved = True
+        self.emit('modified-changed')
+
     def set_transparent_mode(self, mode):
         if self.transparent_mode == mode:
             return
+        if self.log:
+            self.log.set_transparent_mode(mode)
         self.transparent_mode = mode
-        if self.transparent_mode:
-            self.surface = self.make_transparent(self.surface)
-            self.original = self.make_transparent(self.original)
-        else:
-            self.surface = self.make_opaque(self.surface)
-            self.original = self.make_opaque(self.original)
+        # The surface is converted in place. Surfaces in history are converted
+        # when they are loaded.
+        convert = self.make_transparent if self.transparent_mode else self.make_opaque
+        self.surface = convert(self.surface)
+        self.composite = None
+        self._damage()
+
+    def set_log(self, log):
+        # Records the operations to log, an oplog.Recorder, or stops if None.
+        # While recording, undo and redo do not go back beyond the canvas the
+        # log starts from.
+        if self.log:
+            self.log.close()
+        self.log = log
+        self.log_depth = len(self.undo)
+        self.log_redo = len(self.redo)
+
+    def set_session(self, session):
+        # Sets the session.Session the image has been saved in, or None to
+        # write the whole session file next time.
+        self.session = session
+        self.unwritten = None
 
     def set_source_rgba(self, cr):
         if self.transparent_mode and self.appending:
@@ -1158,9 +2030,20 @@ class PaintBuffer(GObject.Object):
         self.surface = surface
         if self.get_transparent_mode():
             self.surface = self.make_transparent(surface)
+        self._damage()
+
+    def take_changes(self):
+        # Returns the area changed since the last call, or None.
+        changed, self.changed = self.changed, None
+        return changed
 
-    def write_to_png(self, fobj):
-        self.surface.write_to_png(fobj)
+    def write(self, fobj, codec, **options):
+        # Writes the image with a codec.Codec
+        codec.write(self.surface, fobj, self.background_color, **options)
+
+    def write_to_png(self, fobj, **options):
+        # See codec.write_png() for the options.
+        write_png(self.surface, fobj, **options)
 
 
 class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
@@ -1174,7 +2057,8 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
         'tool': (GObject.SIGNAL_RUN_FIRST, None, (str,)),
         'undo': (GObject.SIGNAL_RUN_LAST, None, ()),
         'style-changed': (GObject.SIGNAL_RUN_FIRST, None, ()),
-        'tool-changed': (GObject.SIGNAL_RUN_FIRST, None, ())
+        'tool-changed': (GObject.SIGNAL_RUN_FIRST, None, ()),
+        'busy-changed': (GObject.SIGNAL_RUN_FIRST, None, ())
     }
 
     def __init__(self, buffer=None):
@@ -1186,13 +2070,26 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
         self.antialias = True
         self.color = (0, 0, 0, 1)
         self.line_width = 1
+        self.fill_mode = (FILL_TOLERANCE, FILL_CONNECTIVITY)
         self.tool_cls = Pencil
         self.tool = Pencil(self)
         self.set_buffer(buffer)
         self.caret = Gdk.Rectangle()
         self.set_font(package.get_document_font_name())
         self.last_mouse_point = (-1, -1)
-        self.clock = False
+        self.animation = 0          # the timeout for animation
+        self.active_handler = 0     # notified when the toplevel window is activated
+        # Motion events are handled together once a frame.
+        self.motions = []           # pointer positions since the last frame
+        self.motion_event = None    # the last motion event
+        self.motion_tick = 0
+        self.damage = None      # the area the tool has painted in the last frame
+        # A large flood fill searches the pixels to fill in a worker thread.
+        # The tools released meanwhile are appended after the fill.
+        self.fill = None            # the fill being searched
+        self.fill_thread = None     # at most one worker thread at a time
+        self.searched = None        # the fill the worker thread is searching
+        self.pending = []           # the tools queued behind the fill
 
         self.connect("draw", self.on_draw)
         self.connect('configure-event', self.on_configure)
@@ -1205,6 +2102,9 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
         self.connect('button-release-event', self.on_mouse_release)
         self.connect('enter-notify-event', self.on_crossing)
         self.connect('leave-notify-event', self.on_crossing)
+        self.connect('map', self.on_map)
+        self.connect('unmap', self.on_unmap)
+        self.connect('realize', self.on_realize)
         self.add_events(Gdk.EventMask.BUTTON_PRESS_MASK |
                         Gdk.EventMask.POINTER_MOTION_MASK |
                         Gdk.EventMask.BUTTON_RELEASE_MASK |
@@ -1212,22 +2112,80 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
                         Gdk.EventMask.ENTER_NOTIFY_MASK |
                         Gdk.EventMask.LEAVE_NOTIFY_MASK)
 
+    def _animate(self):
+        if not self._can_animate():
+            self.animation = 0
+            return GLib.SOURCE_REMOVE
+        for rect in self.tool.get_animation_rects(self.buffer):
+            if rect is None:
+                self.queue_draw()
+                break
+            self._queue_draw_rect(rect)
+        return GLib.SOURCE_CONTINUE
+
+    def _append(self, tool):
+        if self.fill is not None:
+            self.pending.append(tool)
+        elif isinstance(tool, FloodFill) and FILL_THREAD_LIMIT <= self.width * self.height:
+            self._start_fill(tool)
+        else:
+            self.buffer.append(tool)
+
     def _change_tool(self, tool_cls):
         self.tool_cls = tool_cls
         self.tool = tool_cls(self)
         self.tool.set_antialias(self.antialias)
         self.tool.set_color(*self.color)
         self.tool.set_line_width(self.line_width)
+        self.tool.set_fill_mode(*self.fill_mode)
         self._update_cursor(*self.last_mouse_point, False)
         self.emit('tool-changed')
 
     def _commit_selection(self):
         if self.tool.has_selection():
             self.im.reset()
-            self.buffer.append(self.tool)
+            self._append(self.tool)
             return True
         return False
 
+    def _finish_fill(self, tool):
+        if tool is not self.searched:
+            return GLib.SOURCE_REMOVE   # already finished by wait_fill()
+        self.searched = None
+        self.fill_thread = None
+        if tool is not self.fill:
+            # Canceled; start the fill waiting for the worker thread if any.
+            if self.fill is not None:
+                self._run_fill()
+            return GLib.SOURCE_REMOVE
+        logger.info("fill finished")
+        self.fill = None
+        self.buffer.append(tool)
+        self._flush_pending()
+        return GLib.SOURCE_REMOVE
+
+    def _flush_motions(self):
+        if self.motion_tick:
+            self.remove_tick_callback(self.motion_tick)
+            self.motion_tick = 0
+        event, self.motion_event = self.motion_event, None
+        if event is None:
+            return
+        points, self.motions = self.motions, []
+        if points:
+            self.tool.on_mouse_motion(self, event, points)
+            self._queue_draw_tool()
+        self._update_cursor(*self.last_mouse_point, event.state & Gdk.ModifierType.BUTTON1_MASK)
+
+    def _flush_pending(self):
+        # Appends the queued tools until another large fill starts.
+        pending, self.pending = self.pending, []
+        for tool in pending:
+            self._append(tool)
+        self.queue_draw()
+        if self.fill is None:
+            self.emit('busy-changed')
+
     def _get_offset(self):
         width = self.get_allocated_width()
         height = self.get_allocated_height()
@@ -1248,6 +2206,38 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
     def _has_preedit(self):
         return self.preedit[0]
 
+    def _motion_tick(self, wid, frame_clock):
+        self.motion_tick = 0
+        self._flush_motions()
+        return GLib.SOURCE_REMOVE
+
+    def _queue_draw_rect(self, rect):
+        dx, dy = self._get_offset()
+        self.queue_draw_area(rect[0] - dx, rect[1] - dy, rect[2], rect[3])
+
+    def _queue_draw_tool(self, commit=False):
+        # Redraws the area the tool painted in the last frame and will paint
+        # in the next frame. If commit is True, the tool is about to be
+        # drawn into the buffer and replaced.
+        if commit:
+            rect = self.tool.get_extents(self.buffer)
+        else:
+            rect = self.tool.get_damage(self.buffer)
+        damage, self.damage = self.damage, rect
+        if rect is None or damage is None:
+            self.queue_draw()
+        else:
+            self._queue_draw_rect(union_rect(rect, damage))
+        if commit:
+            self.damage = (0, 0, 0, 0)
+
+    def _is_deferred(self, tool):
+        # Returns True if tool cannot be drawn until the worker thread has
+        # found the pixels to fill.
+        if not isinstance(tool, FloodFill):
+            return False
+        return self.fill is not None or FILL_THREAD_LIMIT <= self.width * self.height
+
     def _init_immultiontext(self):
         self.im = Gtk.IMMulticontext()
         self.im.connect("commit", self.on_commit)
@@ -1262,12 +2252,49 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
         self._hadjustment = self._vadjustment = None
         self._hadjust_signal = self._vadjust_signal = None
 
-    def _timeout(self):
-        if self.tool.has_animation():
-            self.queue_draw()
-            return True
-        self.clock = False
-        return False
+    def _can_animate(self):
+        # Animate only while the canvas is visible in the active window.
+        if not self.tool.has_animation() or not self.get_mapped():
+            return False
+        toplevel = self.get_toplevel()
+        if not toplevel.is_toplevel() or not toplevel.is_active():
+            return False
+        window = toplevel.get_window()
+        return window is not None and not window.get_state() & Gdk.WindowState.ICONIFIED
+
+    def _run_fill(self):
+        # Searches the pixels of the surface, which is not modified while the
+        # tools are queued behind the fill; see cancel_fill().
+        self.searched = self.fill
+        pixels = self.buffer.get_pixels()
+        self.fill_thread = threading.Thread(target=self._search_fill, args=(self.fill, self.buffer, pixels),
+                                            daemon=True)
+        self.fill_thread.start()
+
+    def _search_fill(self, tool, buffer, pixels):
+        # Runs in the worker thread; cv2 and numpy release the GIL while
+        # searching.
+        try:
+            tool.search(buffer, pixels)
+        finally:
+            GLib.idle_add(self._finish_fill, tool)
+
+    def _start_fill(self, tool):
+        logger.info("fill started")
+        self.fill = tool
+        if self.fill_thread is None:
+            self._run_fill()
+        # Otherwise the fill waits for the worker thread of a canceled fill.
+        self.emit('busy-changed')
+
+    def _start_animation(self):
+        if not self.animation and self._can_animate():
+            self.animation = GLib.timeout_add(ANIMATION_INTERVAL, self._animate)
+
+    def _stop_animation(self):
+        if self.animation:
+            GLib.source_remove(self.animation)
+            self.animation = 0
 
     def _update_cursor(self, x, y, pressed):
         if (x < 0 or y < 0) and not pressed:
@@ -1276,6 +2303,18 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
             cursor = self.tool.get_cursor(self, x, y, pressed)
         self.get_root_window().set_cursor(Gdk.Cursor.new(cursor))
 
+    def cancel_fill(self):
+        # The worker thread cannot be interrupted; its result is discarded
+        # and the next fill waits for it.
+        if self.fill is None:
+            return
+        logger.info("fill canceled")
+        if self.searched is self.fill:
+            # Leave the pixels being searched to the worker thread.
+            self.buffer.detach_pixels()
+        self.fill = None
+        self._flush_pending()
+
     def do_copy_clipboard(self):
         if not self.tool.has_selection():
             return
@@ -1287,7 +2326,7 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
             return
         clipboard = self.get_clipboard(Gdk.SELECTION_CLIPBOARD)
         if self.tool.cut_clipboard(clipboard, self.buffer):
-            self.buffer.append(self.tool)
+            self._append(self.tool)
             self._change_tool(self.tool_cls)
         self.queue_draw()
 
@@ -1312,7 +2351,7 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
             self.reflow()
 
     def do_redo(self):
-        if self.tool.has_selection():
+        if self.tool.has_selection() or self.fill is not None:
             return
         self.buffer.emit('redo')
         self.queue_draw()
@@ -1325,24 +2364,19 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
 
     def do_tool(self, tool):
         self._commit_selection()
-        cls = {
-            "lasso": Lasso,
-            "selection": Selection,
-            "pencil": Pencil,
-            "eraser": Eraser,
-            "line": Line,
-            "rectangle": Rectangle,
-            "oval": Oval,
-            "text": Text,
-            "floodfill": FloodFill
-        }.get(tool, Pencil)
-        self._change_tool(cls)
+        self._change_tool(TOOLS.get(tool, Pencil))
         self.queue_draw()
 
     def do_undo(self):
         if self._commit_selection():
             self._change_tool(self.tool_cls)
-        self.buffer.emit('undo')
+        if self.pending:
+            # Undo the latest tool queued behind the fill.
+            self.pending.pop()
+        elif self.fill is not None:
+            self.cancel_fill()
+        else:
+            self.buffer.emit('undo')
         self.queue_draw()
 
     def get_antialias(self):
@@ -1351,9 +2385,15 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
     def get_buffer(self):
         return self.buffer
 
+    def get_busy(self):
+        return self.fill is not None
+
     def get_editable(self):
         return True
 
+    def get_fill_mode(self):
+        return self.fill_mode
+
     def get_font(self):
         return self.font
 
@@ -1369,6 +2409,12 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
     def get_vadjustment(self):
         return self._vadjustment
 
+    def on_active_changed(self, window, pspec):
+        if window.is_active():
+            self._start_animation()
+        else:
+            self._stop_animation()
+
     def on_commit(self, im, str):
         if self.tool.on_commit(im, str):
             self.reflow()
@@ -1411,22 +2457,30 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
         return False
 
     def on_draw(self, wid, cr):
-        if not self.clock and self.tool.has_animation():
-            self.clock = True
-            GLib.timeout_add(200, self._timeout)
+        self._start_animation()
         dx, dy = self._get_offset()
         if dx < 0 or dy < 0:
-            cr.rectangle(0, 0, wid.get_allocated_width(), wid.get_allocated_height())
+            # Fill the exposed area outside the canvas.
+            cr.save()
+            cr.rectangle(*get_clip_rect(cr))
+            cr.rectangle(-dx, -dy, self.width, self.height)
+            cr.set_fill_rule(cairo.FillRule.EVEN_ODD)
             cr.set_source_rgba(0.5, 0.5, 0.5, 1)
             cr.fill()
+            cr.restore()
         cr.translate(-dx, -dy)
-        self.buffer.draw(cr)
+        viewport = (dx, dy, self.get_allocated_width(), self.get_allocated_height())
+        self.buffer.draw(cr, wid.get_window(), viewport)
+        for tool in self.pending:
+            if not self._is_deferred(tool):
+                tool.on_draw(cr, self.buffer)
         self.tool.on_draw(cr, self.buffer)
         self.tool.set_cursor_location(self.im, dx, dy)
 
     def on_focus_in(self, wid, event):
         self.im.set_client_window(wid.get_window())
         self.im.focus_in()
+        self._start_animation()
         return True
 
     def on_focus_out(self, wid, event):
@@ -1434,6 +2488,9 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
         return True
 
     def on_key_press(self, wid, event):
+        if event.keyval == Gdk.KEY_Escape and self.fill is not None:
+            self.cancel_fill()
+            return True
         if self.tool.on_key_press(self, self.im, event):
             self.reflow()
             return True
@@ -1442,18 +2499,27 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
     def on_key_release(self, wid, event):
         return self.tool.on_key_release(self, self.im, event)
 
+    def on_map(self, wid):
+        self._start_animation()
+
     def on_mouse_move(self, wid, event):
-        x, y = self._get_offset()
-        x += round(event.x)
-        y += round(event.y)
-        self.last_mouse_point = (x, y)
-        if event.state & Gdk.EventMask.BUTTON_PRESS_MASK:
-            self.tool.on_mouse_move(self, event, x, y)
-            self.queue_draw()
-        self._update_cursor(x, y, event.state & Gdk.ModifierType.BUTTON1_MASK)
+        dx, dy = self._get_offset()
+        x = dx + event.x
+        y = dy + event.y
+        self.last_mouse_point = (round(x), round(y))
+        if not event.state & Gdk.ModifierType.BUTTON1_MASK:
+            # Hovering; only the cursor follows the pointer.
+            self._update_cursor(*self.last_mouse_point, False)
+            return True
+        # The motions while drawing are given to the tool once per frame.
+        self.motions.append((x, y))
+        self.motion_event = event.copy()
+        if not self.motion_tick:
+            self.motion_tick = self.add_tick_callback(self._motion_tick)
         return True
 
     def on_mouse_press(self, wid, event):
+        self._flush_motions()
         x, y = self._get_offset()
         x += round(event.x)
         y += round(event.y)
@@ -1462,21 +2528,26 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
             if self.tool.has_selection() and not self.tool.in_selection(cr, x, y):
                 self._commit_selection()
                 self._change_tool(self.tool_cls)
+                self.damage = None
             self.tool.on_mouse_press(self, event, x, y)
-            self.queue_draw()
+            self._queue_draw_tool()
         self._update_cursor(x, y, True)
         return False
 
     def on_mouse_release(self, wid, event):
+        self._flush_motions()
         x, y = self._get_offset()
         x += round(event.x)
         y += round(event.y)
         if event.button == Gdk.BUTTON_PRIMARY:
             self.tool.on_mouse_release(self, event, x, y)
             if not self.tool.is_selection():
-                self.buffer.append(self.tool)
+                if not self._is_deferred(self.tool):
+                    self._queue_draw_tool(True)
+                self._append(self.tool)
                 self._change_tool(self.tool_cls)
-            self.queue_draw()
+            else:
+                self._queue_draw_tool()
         self._update_cursor(x, y, False)
         return True
 
@@ -1492,16 +2563,25 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
         if self.tool.on_preedit_start(im):
             self.reflow()
 
+    def on_realize(self, wid):
+        # Receive every motion event; they are coalesced once a frame.
+        self.get_window().set_event_compression(False)
+        if not self.active_handler:
+            self.active_handler = self.get_toplevel().connect('notify::is-active', self.on_active_changed)
+
     def on_retrieve_surrounding(self, im):
         self.tool.on_retrieve_surrounding(im)
         return True
 
+    def on_unmap(self, wid):
+        self._stop_animation()
+
     def on_value_changed(self, *whatever):
         self.queue_draw()
 
     def reflow(self):
         self.tool.reflow(self)
-        self.queue_draw()
+        self._queue_draw_tool()
 
     def reset(self):
         if self._commit_selection():
@@ -1519,12 +2599,18 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
             self.buffer = PaintBuffer()
         self.width = self.buffer.get_width()
         self.height = self.buffer.get_height()
+        self.on_configure(self, None)
+        self.queue_draw()
 
     def set_color(self, red, green, blue, alpha=1):
         self.color = (red, green, blue, alpha)
         self.tool.set_color(*self.color)
         self.queue_draw()
 
+    def set_fill_mode(self, tolerance, connectivity):
+        self.fill_mode = (tolerance, connectivity)
+        self.tool.set_fill_mode(tolerance, connectivity)
+
     def set_font(self, font):
         self.font = font
         self.tool.set_font(font)
@@ -1570,6 +2656,13 @@ class PaintView(Gtk.DrawingArea, Gtk.Scrollable):
             )
             self._vadjust_signal = adjustment.connect("value-changed", self.on_value_changed)
 
+    def wait_fill(self):
+        # Applies the fill and the tools queued behind it without returning
+        # to the main loop.
+        while self.fill is not None:
+            self.fill_thread.join()
+            self._finish_fill(self.searched)
+
     hadjustment = GObject.property(
         get_hadjustment, set_hadjustment, type=Gtk.Adjustment
     )
@@ -0,0 +1,257 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import package
+
+from gi.repository import Gio, GLib
+
+from codec import find_codec, get_codecs
+from paint import PaintBuffer
+
+import cairo
+import fcntl
+import io
+import json
+import logging
+import numpy
+import os
+import queue
+import struct
+import threading
+import uuid
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+AUTOSAVE_INTERVAL = 5   # seconds
+COMPRESSION_LEVEL = 1
+MAGIC = b'EPJ1'
+DELTA = b'DLTA'
+# tag, transparent mode, background color, x, y, width, height, length, crc32
+RECORD = struct.Struct('>4sBBBBiiiiII')
+
+
+def get_recovery_dir():
+    return os.path.join(package.get_user_datadir(), 'recovery')
+
+
+def _get_file_stat(file):
+    # Returns the size and the modification time of file
+    info = file.query_info(Gio.FILE_ATTRIBUTE_STANDARD_SIZE + ',' + Gio.FILE_ATTRIBUTE_TIME_MODIFIED,
+                           Gio.FileQueryInfoFlags.NONE, None)
+    return info.get_size(), info.get_attribute_uint64(Gio.FILE_ATTRIBUTE_TIME_MODIFIED)
+
+
+class Journal:
+    # Appends the area of a PaintBuffer changed since the last entry to a
+    # recovery file at idle time, so that the image can be recovered after a
+    # crash. The journal starts from the saved file or a blank canvas; the
+    # file is written in a worker thread and removed when the journal is
+    # closed. path continues the journal of a recovered image.
+    def __init__(self, buffer, file=None, path=None):
+        self.buffer = buffer
+        self.queue = queue.Queue()
+        self.idle = 0
+        self.state = self._get_state()  # the mode and the background color last written
+        if path:
+            self.path = path
+            buffer.take_changes()
+        else:
+            os.makedirs(get_recovery_dir(), exist_ok=True)
+            self.path = os.path.join(get_recovery_dir(), uuid.uuid4().hex + '.journal')
+            self.reset(file)
+        self.thread = threading.Thread(target=self._write, args=(bool(path),), daemon=True)
+        self.thread.start()
+        self.timeout = GLib.timeout_add_seconds(AUTOSAVE_INTERVAL, self._on_timeout)
+
+    def _get_state(self):
+        rgb = tuple(round(255 * i) for i in self.buffer.get_background_color())
+        return self.buffer.get_transparent_mode(), rgb
+
+    def _on_idle(self):
+        self.idle = 0
+        self.update()
+        return GLib.SOURCE_REMOVE
+
+    def _on_timeout(self):
+        if not self.idle:
+            self.idle = GLib.idle_add(self._on_idle, priority=GLib.PRIORITY_LOW)
+        return GLib.SOURCE_CONTINUE
+
+    def _write(self, append):
+        # Runs in the worker thread
+        f = open(self.path, 'r+b' if append else 'wb')
+        # Lock the journal so that it is not recovered while in use.
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if append:
+                # Drop the record torn by the crash, so that the records
+                # appended after it can be recovered.
+                end = _read(f)[2]
+                f.truncate(end)
+                f.seek(end)
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if item[0] == MAGIC:
+                    header = item[1]
+                    file = header.pop('file')
+                    if file:
+                        header['uri'] = file.get_uri()
+                        try:
+                            header['size'], header['mtime'] = _get_file_stat(file)
+                        except GLib.Error as e:
+                            logger.error(e.message)
+                    data = json.dumps(header).encode()
+                    f.seek(0)
+                    f.truncate()
+                    f.write(MAGIC + struct.pack('>I', len(data)) + data)
+                else:
+                    tag, mode, rgb, rect, pixels = item
+                    data = zlib.compress(pixels, COMPRESSION_LEVEL)
+                    f.write(RECORD.pack(tag, mode, *rgb, *rect, len(data), zlib.crc32(data)) + data)
+                f.flush()
+        except OSError as e:
+            logger.error(e)
+        finally:
+            f.close()
+
+    def close(self, remove=True):
+        GLib.source_remove(self.timeout)
+        if self.idle:
+            GLib.source_remove(self.idle)
+            self.idle = 0
+        self.queue.put(None)
+        self.thread.join()
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def reset(self, file=None, full=False):
+        # Starts the journal over from file, or from a blank canvas. If full
+        # is True, the whole canvas is written as the first entry.
+        self.buffer.take_changes()
+        header = {
+            'file': file,
+            'width': self.buffer.get_width(),
+            'height': self.buffer.get_height(),
+            'transparent_mode': self.buffer.get_transparent_mode(),
+        }
+        self.queue.put((MAGIC, header))
+        self.state = self._get_state()
+        if full:
+            self.update((0, 0, self.buffer.get_width(), self.buffer.get_height()))
+
+    def update(self, rect=None):
+        # Copies the changed area to the worker thread.
+        changed = self.buffer.take_changes()
+        rect = rect or changed
+        state = self._get_state()
+        if not rect or not rect[2] or not rect[3]:
+            if self.state == state:
+                return
+            rect = (0, 0, 1, 1)     # to record the background color
+        self.state = state
+        mode, rgb = state
+        pixels = self.buffer.get_pixels(rect).copy()
+        self.queue.put((DELTA, mode, rgb, rect, pixels))
+
+
+def find_journals():
+    # Returns the paths of the journals left by crashed sessions.
+    paths = []
+    try:
+        names = os.listdir(get_recovery_dir())
+    except OSError:
+        return paths
+    for name in sorted(names):
+        if not name.endswith('.journal'):
+            continue
+        path = os.path.join(get_recovery_dir(), name)
+        try:
+            with open(path, 'rb') as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            continue    # in use
+        paths.append(path)
+    return paths
+
+
+def _read(f):
+    # Returns the header, the records, and the end of the last valid record
+    # of the journal f. The header is None if f is not a journal.
+    records = []
+    f.seek(0)
+    if f.read(4) != MAGIC:
+        return None, records, 0
+    try:
+        length = struct.unpack('>I', f.read(4))[0]
+        header = json.loads(f.read(length))
+    except (struct.error, ValueError):
+        return None, records, 0
+    end = f.tell()
+    while True:
+        head = f.read(RECORD.size)
+        if len(head) < RECORD.size:
+            break
+        tag, mode, r, g, b, x, y, width, height, length, crc = RECORD.unpack(head)
+        data = f.read(length)
+        if tag != DELTA or len(data) < length or zlib.crc32(data) != crc:
+            break   # torn by the crash
+        records.append((mode, (r / 255, g / 255, b / 255), (x, y, width, height), data))
+        end = f.tell()
+    return header, records, end
+
+
+def recover(path):
+    # Returns the PaintBuffer and the Gio.File recovered from a journal, or
+    # (None, None) if there is nothing to recover.
+    with open(path, 'rb') as f:
+        header, records = _read(f)[:2]
+    if not records:
+        return None, None
+
+    file = None
+    buffer = None
+    if header.get('uri'):
+        file = Gio.File.new_for_uri(header['uri'])
+        try:
+            if _get_file_stat(file) != (header.get('size'), header.get('mtime')):
+                raise ValueError('the file has been changed since ' + path)
+            data = file.load_contents(None)[1]
+            codec = find_codec(file.get_basename()) or get_codecs()[0]
+            buffer = PaintBuffer.create_from_file(io.BytesIO(data), codec)
+        except (GLib.Error, ValueError, cairo.Error) as e:
+            logger.error(e)
+            buffer = None
+    if buffer is None or (buffer.get_width(), buffer.get_height()) != (header['width'], header['height']):
+        # Recover the changes over a blank canvas as an untitled image, so
+        # that it is not saved over the file.
+        file = None
+        buffer = PaintBuffer(header['width'], header['height'])
+    buffer.set_transparent_mode(header['transparent_mode'])
+    for mode, rgb, rect, data in records:
+        # A mode change is followed by the whole canvas.
+        buffer.set_transparent_mode(bool(mode))
+        buffer.set_background_color(rgb)
+        with buffer.modify_pixels(rect) as pixels:
+            pixels[...] = numpy.frombuffer(zlib.decompress(data), dtype=numpy.uint8).reshape(pixels.shape)
+    buffer.set_unsaved()
+    return buffer, file
@@ -0,0 +1,328 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import package
+
+import cairo
+import gettext
+import logging
+import mmap
+import numpy
+import os
+import struct
+import sys
+import zlib
+
+from codec import Codec, register_codec
+
+
+_ = lambda a: gettext.dgettext(package.get_domain(), a)
+logger = logging.getLogger(__name__)
+
+# A session file consists of the header, the ARGB32 pixels of the canvas as
+# they are in memory, and the undo history. The pixels start at a page
+# boundary so that they can be mapped into memory as a cairo surface.
+#
+# The first page keeps two copies of the header with a CRC-32 each; the valid
+# one with the larger generation is current. Writing back changes writes the
+# new history and the changed rows to unused space first, and then commits a
+# header of the next generation in the other slot, which refers to them as a
+# journal. The rows are copied in place only after that, so that the rows can
+# be copied again after a crash.
+MAGIC = b'EPAINT\r\n'
+VERSION = 1
+# magic, version, flags, width, height, stride, background color, offset and
+# length of the pixels, offset and length of the history, generation, offset
+# and length of the journal, and the first row of the journal
+HEADER = struct.Struct('<8sIIIIIBBBxQQQQQQQI')
+CRC = struct.Struct('<I')
+SLOT_SIZE = 512
+FLAG_TRANSPARENT = 1
+FLAG_BIG_ENDIAN = 2
+PAGE_SIZE = mmap.ALLOCATIONGRANULARITY
+COMPRESSION_LEVEL = 1
+
+UNDO = 0
+REDO = 1
+# kind, transparent modes before and after, x, y, width, height, and the
+# lengths of the compressed pixels before and after
+STEP = struct.Struct('<BBBxiiiiII')
+
+
+def _align(offset):
+    return (offset + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+
+
+def _compress(data):
+    # data is either compressed pixels or a surface
+    if isinstance(data, bytes):
+        return data
+    data.flush()
+    return zlib.compress(data.get_data(), COMPRESSION_LEVEL)
+
+
+def _commit(f, fields):
+    # Writes the header of fields in the slot of its generation, and makes
+    # it durable.
+    header = HEADER.pack(*fields)
+    f.seek(fields[13] % 2 * SLOT_SIZE)
+    f.write(header + CRC.pack(zlib.crc32(header)))
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _read_header(data):
+    # Returns the fields of the current header in the first page data.
+    current = None
+    for slot in range(2):
+        header = data[slot * SLOT_SIZE:slot * SLOT_SIZE + HEADER.size + CRC.size]
+        if len(header) < HEADER.size + CRC.size:
+            break
+        if CRC.unpack_from(header, HEADER.size)[0] != zlib.crc32(header[:HEADER.size]):
+            continue
+        fields = HEADER.unpack_from(header)
+        if fields[0] != MAGIC or VERSION < fields[1]:
+            continue
+        if current is None or current[13] < fields[13]:
+            current = fields
+    if current is None:
+        raise ValueError(_("Unsupported image data"))
+    return current
+
+
+def _swap(data):
+    # Converts the pixels from the other byte order.
+    data = bytearray(data)
+    numpy.frombuffer(data, dtype=numpy.uint32).byteswap(inplace=True)
+    return data
+
+
+class Session:
+    # The layout of a session file at path. The pixels are mapped into
+    # memory copy-on-write, so that pages are read lazily as they are viewed
+    # and changes to them stay in memory until they are written back. The
+    # journal left by a crash while writing back is applied on opening.
+    def __init__(self, path):
+        self.path = path
+        self.maps = []      # mappings which keep their pixels when the file is written back
+        self.journal = None     # the rows of the journal not applied to the file
+        with open(path, 'rb') as f:
+            self.fields = _read_header(f.read(2 * SLOT_SIZE))
+        (magic, version, flags, self.width, self.height, self.stride, r, g, b,
+         self.offset, self.size, self.history_offset, self.history_length,
+         self.generation, journal_offset, journal_length, self.journal_row) = self.fields
+        if self.stride != cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, self.width):
+            raise ValueError(_("Unsupported image data"))
+        self.transparent_mode = bool(flags & FLAG_TRANSPARENT)
+        self.native = bool(flags & FLAG_BIG_ENDIAN) == (sys.byteorder == 'big')
+        self.background_color = (r / 255, g / 255, b / 255)
+        if journal_length:
+            with open(path, 'rb') as f:
+                f.seek(journal_offset)
+                self.journal = f.read(journal_length)
+            if len(self.journal) < journal_length:
+                # Truncated after it has been applied.
+                self.journal = None
+                return
+            try:
+                with open(path, 'r+b') as f:
+                    self._apply_journal(f)
+            except OSError as e:
+                # Apply the journal to the mapped pixels instead.
+                logger.warning(e)
+
+    def _apply_journal(self, f):
+        # Copies the rows of the journal in place, and commits the header
+        # without the journal.
+        f.seek(self.offset + self.journal_row * self.stride)
+        f.write(self.journal)
+        f.flush()
+        os.fsync(f.fileno())
+        self.journal = None
+        self.commit(f, self.fields[:11], self.history_offset, self.history_length)
+        f.truncate(self.history_offset + self.history_length)
+
+    def commit(self, f, header, history_offset, history_length, journal_offset=0, journal_length=0, row=0):
+        # Commits the header of the next generation in f. header is the
+        # fields up to the length of the pixels, and the journal is of the
+        # rows from row.
+        self.generation += 1
+        self.fields = tuple(header) + (history_offset, history_length, self.generation,
+                                       journal_offset, journal_length, row)
+        _commit(f, self.fields)
+        self.history_offset = history_offset
+        self.history_length = history_length
+
+    def is_writable(self, width, height):
+        # Returns True if the pixels of width x height can be written back.
+        return self.native and self.journal is None and (self.width, self.height) == (width, height)
+
+    def map(self, keep=False):
+        # Returns a surface of the pixels. If keep is True, the surface keeps
+        # its pixels when the file is written back, as long as it is not
+        # modified.
+        with open(self.path, 'rb') as f:
+            if not self.native:
+                f.seek(self.offset)
+                data = _swap(f.read(self.size))
+            else:
+                data = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_COPY, offset=self.offset)
+                if keep:
+                    self.maps.append(data)
+            if self.journal is not None:
+                start = self.journal_row * self.stride
+                data[start:start + len(self.journal)] = _swap(self.journal) if not self.native else self.journal
+        return cairo.ImageSurface.create_for_data(data, cairo.FORMAT_ARGB32,
+                                                  self.width, self.height, self.stride)
+
+    def pin(self, start, stop):
+        # Copies the rows from start to stop of the mappings to be kept into
+        # private pages before they are written back.
+        for data in self.maps:
+            rows = numpy.frombuffer(data, dtype=numpy.uint8)[start * self.stride:stop * self.stride]
+            rows[...] = rows.copy()
+
+    def read_steps(self):
+        # Yields the undo history as (kind, rect, before, after), where before
+        # and after are the transparent modes and the compressed pixels.
+        with open(self.path, 'rb') as f:
+            f.seek(self.history_offset)
+            history = f.read(self.history_length)
+        offset = 0
+        while offset + STEP.size <= len(history):
+            kind, before_mode, after_mode, x, y, width, height, before_length, after_length = \
+                STEP.unpack_from(history, offset)
+            offset += STEP.size
+            before = history[offset:offset + before_length]
+            offset += before_length
+            after = history[offset:offset + after_length]
+            offset += after_length
+            if not self.native and before:
+                before = zlib.compress(_swap(zlib.decompress(before)), COMPRESSION_LEVEL)
+                after = zlib.compress(_swap(zlib.decompress(after)), COMPRESSION_LEVEL)
+            yield kind, (x, y, width, height), (bool(before_mode), before), (bool(after_mode), after)
+
+
+class Snapshot:
+    # The state of a PaintBuffer to be saved in a session file in another
+    # thread. pixels is a surface of the whole canvas, or the bytes of the
+    # rows from start to be written back to the session file. steps are the
+    # undo history as (kind, rect, before, after), where before and after
+    # are the transparent modes and the compressed pixels or surfaces.
+    def __init__(self, width, height, pixels, transparent_mode=False, background_color=(1, 1, 1),
+                 steps=(), start=None):
+        self.width = width
+        self.height = height
+        self.pixels = pixels
+        self.transparent_mode = transparent_mode
+        self.background_color = background_color
+        self.steps = steps
+        self.start = start
+
+    def _get_header(self):
+        # Returns the fields of the header up to the length of the pixels.
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, self.width)
+        flags = FLAG_TRANSPARENT if self.transparent_mode else 0
+        if sys.byteorder == 'big':
+            flags |= FLAG_BIG_ENDIAN
+        r, g, b = (round(255 * i) for i in self.background_color)
+        return MAGIC, VERSION, flags, self.width, self.height, stride, r, g, b, PAGE_SIZE, stride * self.height
+
+    def _get_history(self):
+        history = []
+        for kind, rect, before, after in self.steps:
+            before_data = _compress(before[1]) if before else b''
+            after_data = _compress(after[1]) if after else b''
+            history.append(STEP.pack(kind, bool(before and before[0]), bool(after and after[0]), *rect,
+                                     len(before_data), len(after_data)))
+            history += (before_data, after_data)
+        return b''.join(history)
+
+    def is_incremental(self):
+        return self.start is not None
+
+    def write(self, fobj):
+        # Writes the whole session file to fobj.
+        self.pixels.flush()
+        data = self.pixels.get_data()
+        history = self._get_history()
+        history_offset = _align(PAGE_SIZE + len(data))
+        header = HEADER.pack(*self._get_header(), history_offset, len(history), 0, 0, 0, 0)
+        header += CRC.pack(zlib.crc32(header))
+        fobj.write(header + bytes(PAGE_SIZE - len(header)))
+        fobj.write(data)
+        fobj.write(bytes(history_offset - PAGE_SIZE - len(data)))
+        fobj.write(history)
+
+    def write_back(self, session):
+        # Writes the changed rows and the history back to the session file.
+        # The new history and the rows are written where they do not overlap
+        # the current ones, and committed as a journal before the rows are
+        # copied in place; see the comment on the file format.
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, self.width)
+        header = self._get_header()
+        history = self._get_history()
+        rows = self.pixels or b''
+        offset = _align(session.offset + session.size)
+        if session.history_offset < offset + len(history) + len(rows):
+            offset = _align(session.history_offset + session.history_length)
+        with open(session.path, 'r+b') as f:
+            f.seek(offset)
+            f.write(history)
+            f.write(rows)
+            f.flush()
+            os.fsync(f.fileno())
+            if rows:
+                session.commit(f, header, offset, len(history), offset + len(history), len(rows), self.start)
+                session.pin(self.start, self.start + len(rows) // stride)
+                f.seek(session.offset + self.start * stride)
+                f.write(rows)
+                f.flush()
+                os.fsync(f.fileno())
+            session.commit(f, header, offset, len(history))
+            f.truncate(offset + len(history))
+
+
+class SessionCodec(Codec):
+    # The native format which keeps the canvas uncompressed with its undo
+    # history. Window opens local session files with Session instead to map
+    # them into memory; this codec reads and writes them as streams.
+    def __init__(self):
+        super().__init__(_("Paint sessions"), ("application/x-esrille-paint",), ("epaint",))
+
+    def read(self, fobj):
+        data = fobj.read()
+        (magic, version, flags, width, height, stride, r, g, b, offset, size,
+         history_offset, history_length, generation, journal_offset, journal_length, row) = _read_header(data)
+        if len(data) < offset + size:
+            raise ValueError(_("Unsupported image data"))
+        pixels = bytearray(data[offset:offset + size])
+        if journal_offset + journal_length <= len(data):
+            # Apply the journal left by a crash while writing back.
+            pixels[row * stride:row * stride + journal_length] = data[journal_offset:journal_offset + journal_length]
+        if bool(flags & FLAG_BIG_ENDIAN) != (sys.byteorder == 'big'):
+            pixels = _swap(pixels)
+        return cairo.ImageSurface.create_for_data(pixels, cairo.FORMAT_ARGB32, width, height, stride)
+
+    def write(self, surface, fobj, background_color=(1, 1, 1), **options):
+        # surface can be a Snapshot to save the history as well.
+        if not isinstance(surface, Snapshot):
+            surface = Snapshot(surface.get_width(), surface.get_height(), surface,
+                               background_color=background_color)
+        surface.write(fobj)
+
+
+register_codec(SessionCodec())
@@ -20,12 +20,19 @@ import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gio, GLib, Gtk, Gdk, GObject
 
-from paint import PaintBuffer, PaintView
+from codec import FAST_SAVE, find_codec, get_codecs
+from oplog import Recorder
+from paint import HISTORY_DELTA, HISTORY_REPLAY, PaintBuffer, PaintView
+from recovery import Journal
+from session import Session, SessionCodec
 
 import gettext
 import logging
+import mmap
 import os
 import subprocess
+import threading
+import time
 
 
 _ = lambda a: gettext.dgettext(package.get_domain(), a)
@@ -33,6 +40,9 @@ logger = logging.getLogger(__name__)
 
 DEFAULT_WIDTH = 1024
 DEFAULT_HEIGHT = 600
+LOAD_CHUNK = 1024 * 1024            # bytes read at a time
+READ_CHUNK = 8 * 1024 * 1024        # bytes read at a time by GioStream
+WRITE_BUFFER = 16 * 1024 * 1024     # bytes GioStream keeps before writing them out
 
 
 def parse_int(s):
@@ -44,23 +54,92 @@ def parse_int(s):
     return int(digits) if digits else None
 
 
-# Treat a Gio.File as a Python file like object
+# Treat a Gio.File as a Python file like object. For reading, the whole
+# file is mapped into memory if it is local, or read at once into a buffer
+# otherwise; data can also be given as the bytes already read. For writing,
+# the bytes are buffered and written out in large blocks.
 class GioStream:
-    def __init__(self, file, writable=False):
+    def __init__(self, file, writable=False, stream=None, data=None):
         self.file = file
-        if not writable:
-            self.stream = file.read(None)
+        self.stream = stream
+        self.map = None
+        self.data = None        # memoryview of the whole file
+        self.position = 0
+        self.buffer = []        # bytes to be written
+        self.buffered = 0
+        if writable:
+            if not stream:
+                self.stream = file.replace(None, False, Gio.FileCreateFlags.NONE, None)
+        elif data is not None:
+            self.data = memoryview(data)
+        elif file.get_path():
+            with open(file.get_path(), 'rb') as f:
+                if 0 < os.fstat(f.fileno()).st_size:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self.data = memoryview(self.map)
+                else:
+                    self.data = memoryview(b'')
         else:
-            self.stream = file.replace(None, False, Gio.FileCreateFlags.NONE, None)
+            self.data = memoryview(self._read_all())
 
-    def read(self, size):
-        b = self.stream.read_bytes(size)
-        if b:
-            return b.get_data()
-        return bytes()
+    def _read_all(self):
+        info = self.file.query_info(Gio.FILE_ATTRIBUTE_STANDARD_SIZE, Gio.FileQueryInfoFlags.NONE, None)
+        data = bytearray(info.get_size())
+        length = 0
+        stream = self.file.read(None)
+        try:
+            while True:
+                b = stream.read_bytes(READ_CHUNK, None)
+                size = b.get_size()
+                if not size:
+                    break
+                if len(data) < length + size:
+                    data.extend(bytes(length + size - len(data)))
+                data[length:length + size] = b.get_data()
+                length += size
+        finally:
+            stream.close(None)
+        del data[length:]
+        return data
+
+    def close(self):
+        if self.stream:
+            self.flush()
+            self.stream.close(None)
+            self.stream = None
+        if self.data is not None:
+            self.data.release()
+            self.data = None
+        if self.map:
+            self.map.close()
+            self.map = None
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write_all(b''.join(self.buffer), None)
+            self.buffer = []
+            self.buffered = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data) - self.position
+        b = self.data[self.position:self.position + size].tobytes()
+        self.position += len(b)
+        return b
+
+    def readinto(self, b):
+        view = self.data[self.position:self.position + len(b)]
+        size = len(view)
+        b[:size] = view
+        self.position += size
+        return size
 
     def write(self, b):
-        return self.stream.write(b, None)
+        self.buffer.append(bytes(b))
+        self.buffered += len(b)
+        if WRITE_BUFFER <= self.buffered:
+            self.flush()
+        return len(b)
 
 
 class PalletDialog(Gtk.Dialog):
@@ -109,7 +188,7 @@ class Window(Gtk.ApplicationWindow):
         'tool': (GObject.SIGNAL_RUN_FIRST, None, (str,))
     }
 
-    def __init__(self, app, file=None, buffer=None, transparent_mode=True):
+    def __init__(self, app, file=None, buffer=None, transparent_mode=True, journal=None):
         self.title = _("Paint")
         super().__init__(application=app, title=self.title)
         self.set_default_icon_name(package.get_name())
@@ -183,21 +262,45 @@ class Window(Gtk.ApplicationWindow):
         scrolled_window.set_vexpand(True)
         scrolled_window.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.AUTOMATIC)
 
-        self.buffer = None
-        if file:
-            buffer = self._load_file(file)
-        else:
-            self.file = None
+        self.file = None
+        self.loading = None     # Gio.Cancellable while the file is loaded
+        self.load_size = 0      # the size of the file
+        self.load_data = None   # bytearray of load_size bytes to read the file into
+        self.load_length = 0    # bytes read so far
+        self.pulse = 0
+        self.saving = None      # Gio.Cancellable while the file is saved
+        self.close_after_save = False
+        self.save_options = {}  # the values of the codec options by name
+        self.fast_save = False
         self.paintview = PaintView(buffer)
         self.buffer = self.paintview.get_buffer()
         self.buffer.set_transparent_mode(transparent_mode)
         self.buffer.connect_after("modified-changed", self.on_modified_changed)
         self.paintview.connect_after("style-changed", self.on_style_changed)
         self.paintview.connect_after("tool-changed", self.on_tool_changed)
+        self.paintview.connect_after("busy-changed", self.on_busy_changed)
 
         scrolled_window.add(self.paintview)
         overlay.add(scrolled_window)
 
+        self.spinner = Gtk.Spinner()
+        self.spinner.set_halign(Gtk.Align.END)
+        self.spinner.set_valign(Gtk.Align.START)
+        self.spinner.set_margin_top(8)
+        self.spinner.set_margin_end(8)
+        self.spinner.set_size_request(32, 32)
+        self.spinner.set_tooltip_text(_('Filling… Press Esc to cancel'))
+        self.spinner.set_no_show_all(True)
+        overlay.add_overlay(self.spinner)
+
+        self.progress = Gtk.ProgressBar()
+        self.progress.set_halign(Gtk.Align.CENTER)
+        self.progress.set_valign(Gtk.Align.CENTER)
+        self.progress.set_size_request(256, -1)
+        self.progress.set_show_text(True)
+        self.progress.set_no_show_all(True)
+        overlay.add_overlay(self.progress)
+
         self.connect_after("key-press-event", self.on_key_press_event)
         self.connect_after('button-press-event', self.on_mouse_press)
         self.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
@@ -217,7 +320,9 @@ class Window(Gtk.ApplicationWindow):
             "paste": self.paste_callback,
             "selectall": self.select_all_callback,
             "font": self.font_callback,
+            "fill-tolerance": self.fill_tolerance_callback,
             "background-color": self.background_color_callback,
+            "undo-memory": self.undo_memory_callback,
             "help": self.help_callback,
             "about": self.about_callback,
         }
@@ -226,30 +331,190 @@ class Window(Gtk.ApplicationWindow):
             action.connect("activate", method)
             self.add_action(action)
         self.connect("delete-event", self.on_delete_event)
+        self.connect("destroy", self.on_destroy)
 
         action = Gio.SimpleAction.new_stateful(
             "antialias", None, GLib.Variant.new_boolean(self.paintview.get_antialias()))
         action.connect("activate", self.antialias_callback)
         self.add_action(action)
 
+        action = Gio.SimpleAction.new_stateful(
+            "fast-save", None, GLib.Variant.new_boolean(self.fast_save))
+        action.connect("activate", self.fast_save_callback)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new_stateful(
+            "replay-undo", None,
+            GLib.Variant.new_boolean(self.buffer.get_history_mode() == HISTORY_REPLAY))
+        action.connect("activate", self.replay_undo_callback)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new_stateful(
+            "record-operations", None, GLib.Variant.new_boolean(False))
+        action.connect("activate", self.record_operations_callback)
+        self.add_action(action)
+
+        action = Gio.SimpleAction.new_stateful(
+            "fill-8-way", None, GLib.Variant.new_boolean(self.paintview.get_fill_mode()[1] == 8))
+        action.connect("activate", self.fill_8_way_callback)
+        self.add_action(action)
+
         action = Gio.SimpleAction.new_stateful(
             "transparent-selection-mode", None, GLib.Variant.new_boolean(transparent_mode))
         action.connect("activate", self.transparent_selection_mode_callback)
         self.add_action(action)
 
         self.paintview.grab_focus()
+        if file and not buffer:
+            self.journal = None
+            self._load_file(file)
+        else:
+            # journal is the path of the recovery journal to continue.
+            self.file = file
+            self.on_modified_changed(self.buffer)
+            self.journal = Journal(self.buffer, file, journal)
+
+    def _decode(self, cancellable, file, data, transparent_mode):
+        # Runs in a worker thread
+        try:
+            start = time.perf_counter()
+            codec = find_codec(file.get_basename()) or get_codecs()[0]
+            if isinstance(codec, SessionCodec) and file.get_path():
+                # Map the session file into memory; it keeps its own mode.
+                buffer = PaintBuffer.create_from_session(file.get_path())
+            else:
+                stream = GioStream(file, data=data)
+                try:
+                    buffer = PaintBuffer.create_from_file(stream, codec)
+                finally:
+                    stream.close()
+                buffer.set_transparent_mode(transparent_mode)
+            logger.debug("decoded in %.3f sec", time.perf_counter() - start)
+        except Exception as e:
+            GLib.idle_add(self._on_load_error, cancellable, str(e))
+        else:
+            GLib.idle_add(self._on_loaded, cancellable, buffer)
+
+    def _finish_loading(self):
+        self.loading = None
+        self.load_data = None
+        if self.pulse:
+            GLib.source_remove(self.pulse)
+            self.pulse = 0
+        self.progress.hide()
+        self.paintview.set_sensitive(True)
+        self.paintview.grab_focus()
 
     def _load_file(self, file):
-        buffer = None
-        if file:
-            try:
-                stream = GioStream(file)
-                buffer = PaintBuffer.create_from_png(stream)
-            except GObject.GError as e:
-                file = None
-                logger.error(e.message)
+        # Reads file asynchronously and decodes it in a worker thread. The
+        # blank canvas is shown insensitive until the image is swapped in.
         self.set_file(file)
-        return buffer
+        self.loading = Gio.Cancellable()
+        self.load_size = 0
+        self.load_data = None
+        self.load_length = 0
+        self.paintview.set_sensitive(False)
+        self.progress.set_fraction(0)
+        self.progress.set_text(_("Loading…"))
+        self.progress.show()
+        file.query_info_async(Gio.FILE_ATTRIBUTE_STANDARD_SIZE, Gio.FileQueryInfoFlags.NONE,
+                              GLib.PRIORITY_DEFAULT, self.loading, self._on_load_info, self.loading)
+
+    def _on_load_bytes(self, stream, result, cancellable):
+        try:
+            b = stream.read_bytes_finish(result)
+        except GLib.Error as e:
+            stream.close_async(GLib.PRIORITY_DEFAULT, None, None)
+            self._on_load_error(cancellable, e.message)
+            return
+        size = b.get_size()
+        if size:
+            if len(self.load_data) < self.load_length + size:
+                self.load_data.extend(bytes(self.load_length + size - len(self.load_data)))
+            self.load_data[self.load_length:self.load_length + size] = b.get_data()
+            self.load_length += size
+            if self.load_size:
+                self.progress.set_fraction(min(1, self.load_length / self.load_size))
+            stream.read_bytes_async(LOAD_CHUNK, GLib.PRIORITY_DEFAULT, cancellable,
+                                    self._on_load_bytes, cancellable)
+            return
+        stream.close_async(GLib.PRIORITY_DEFAULT, None, None)
+        data = memoryview(self.load_data)[:self.load_length]
+        self.load_data = None
+        self._start_decoding(cancellable, self.file, data)
+
+    def _on_load_error(self, cancellable, message):
+        if cancellable.is_cancelled():
+            return GLib.SOURCE_REMOVE
+        logger.error(message)
+        self._finish_loading()
+        self.set_file(None)
+        self.journal = Journal(self.buffer)
+        dialog = Gtk.MessageDialog(
+            self, 0, Gtk.MessageType.ERROR,
+            Gtk.ButtonsType.OK, _("Failed to open image."))
+        dialog.format_secondary_text(message)
+        dialog.connect("response", self.message_response_callback)
+        dialog.show()
+        return GLib.SOURCE_REMOVE
+
+    def _on_load_info(self, file, result, cancellable):
+        try:
+            info = file.query_info_finish(result)
+        except GLib.Error as e:
+            self._on_load_error(cancellable, e.message)
+            return
+        if file.get_path():
+            # Map local files into memory in the worker thread.
+            self._start_decoding(cancellable, file, None)
+            return
+        self.load_size = info.get_size()
+        self.load_data = bytearray(self.load_size)
+        file.read_async(GLib.PRIORITY_DEFAULT, cancellable, self._on_load_stream, cancellable)
+
+    def _on_load_stream(self, file, result, cancellable):
+        try:
+            stream = file.read_finish(result)
+        except GLib.Error as e:
+            self._on_load_error(cancellable, e.message)
+            return
+        stream.read_bytes_async(LOAD_CHUNK, GLib.PRIORITY_DEFAULT, cancellable,
+                                self._on_load_bytes, cancellable)
+
+    def _on_loaded(self, cancellable, buffer):
+        if cancellable.is_cancelled():
+            return GLib.SOURCE_REMOVE
+        self._finish_loading()
+        if buffer.get_session():
+            action = self.lookup_action("transparent-selection-mode")
+            action.set_state(GLib.Variant.new_boolean(buffer.get_transparent_mode()))
+        else:
+            # The mode may have been changed while loading.
+            buffer.set_transparent_mode(self.buffer.get_transparent_mode())
+        buffer.set_history_mode(self.buffer.get_history_mode())
+        buffer.set_checkpoint_budget(self.buffer.get_checkpoint_budget())
+        if self.buffer.get_log():
+            # The log has been recorded on the blank canvas.
+            self.buffer.set_log(None)
+            self.lookup_action("record-operations").set_state(GLib.Variant.new_boolean(False))
+        self.paintview.set_buffer(buffer)
+        self.buffer = buffer
+        self.buffer.connect_after("modified-changed", self.on_modified_changed)
+        self.set_file(self.file)
+        self.journal = Journal(self.buffer, self.file)
+        return GLib.SOURCE_REMOVE
+
+    def _on_pulse(self):
+        self.progress.pulse()
+        return GLib.SOURCE_CONTINUE
+
+    def _start_decoding(self, cancellable, file, data):
+        self.progress.set_text(_("Decoding…"))
+        self.pulse = GLib.timeout_add(100, self._on_pulse)
+        thread = threading.Thread(target=self._decode,
+                                  args=(cancellable, file, data, self.buffer.get_transparent_mode()),
+                                  daemon=True)
+        thread.start()
 
     def _replace_button_icon(self, button, icon):
         image = Gtk.Image.new_from_icon_name(icon + '-symbolic', Gtk.IconSize.BUTTON)
@@ -277,16 +542,35 @@ class Window(Gtk.ApplicationWindow):
     def about_response_callback(self, dialog, response):
         dialog.destroy()
 
-    def add_filters(self, dialog):
-        filter_text = Gtk.FileFilter()
-        filter_text.set_name(_("PNG images"))
-        filter_text.add_mime_type("image/png")
-        dialog.add_filter(filter_text)
-
-        filter_any = Gtk.FileFilter()
-        filter_any.set_name(_("Any files"))
-        filter_any.add_pattern("*")
-        dialog.add_filter(filter_any)
+    def add_filters(self, dialog, save=False):
+        # Returns the filters added for each codec.
+        filters = {}
+        if not save:
+            filter_images = Gtk.FileFilter()
+            filter_images.set_name(_("Supported images"))
+            for codec in get_codecs():
+                for mime_type in codec.get_mime_types():
+                    filter_images.add_mime_type(mime_type)
+                for extension in codec.get_extensions():
+                    filter_images.add_pattern('*.' + extension)
+            dialog.add_filter(filter_images)
+
+        for codec in get_codecs():
+            filter_text = Gtk.FileFilter()
+            filter_text.set_name(codec.get_name())
+            for mime_type in codec.get_mime_types():
+                filter_text.add_mime_type(mime_type)
+            for extension in codec.get_extensions():
+                filter_text.add_pattern('*.' + extension)
+            dialog.add_filter(filter_text)
+            filters[filter_text] = codec
+
+        if not save:
+            filter_any = Gtk.FileFilter()
+            filter_any.set_name(_("Any files"))
+            filter_any.add_pattern("*")
+            dialog.add_filter(filter_any)
+        return filters
 
     def antialias_callback(self, action, parameter):
         enable = not action.get_state()
@@ -300,6 +584,7 @@ class Window(Gtk.ApplicationWindow):
         dialog.set_rgba(rgba)
         if dialog.run() == Gtk.ResponseType.OK:
             rgba = dialog.get_rgba()
+            self.paintview.wait_fill()
             self.buffer.set_background_color((rgba.red, rgba.green, rgba.blue))
             self.paintview.queue_draw()
         dialog.destroy()
@@ -319,6 +604,10 @@ class Window(Gtk.ApplicationWindow):
 
     def confirm_save_changes(self):
         self.paintview.reset()
+        if self.saving:
+            # Close the window after the pending write
+            self.close_after_save = True
+            return True
         if not self.buffer.get_modified():
             return False
         dialog = Gtk.MessageDialog(
@@ -349,6 +638,33 @@ class Window(Gtk.ApplicationWindow):
     def cut_callback(self, *whatever):
         self.paintview.emit('cut-clipboard')
 
+    def fast_save_callback(self, action, parameter):
+        self.fast_save = not action.get_state()
+        action.set_state(GLib.Variant.new_boolean(self.fast_save))
+
+    def fill_8_way_callback(self, action, parameter):
+        enable = not action.get_state()
+        action.set_state(GLib.Variant.new_boolean(enable))
+        tolerance, connectivity = self.paintview.get_fill_mode()
+        self.paintview.set_fill_mode(tolerance, 8 if enable else 4)
+
+    def fill_tolerance_callback(self, *whatever):
+        dialog = Gtk.Dialog(title=_("Fill Tolerance"), transient_for=self, modal=True, use_header_bar=True)
+        dialog.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        dialog.add_button(Gtk.STOCK_OK, Gtk.ResponseType.OK)
+        dialog.set_default_response(Gtk.ResponseType.OK)
+        tolerance, connectivity = self.paintview.get_fill_mode()
+        scale = Gtk.Scale.new_with_range(Gtk.Orientation.HORIZONTAL, 0, 255, 1)
+        scale.set_value(tolerance)
+        scale.set_digits(0)
+        scale.set_size_request(256, -1)
+        scale.set_tooltip_text(_('Fill the pixels whose colors differ up to this value'))
+        dialog.get_content_area().add(scale)
+        dialog.show_all()
+        if dialog.run() == Gtk.ResponseType.OK:
+            self.paintview.set_fill_mode(int(scale.get_value()), connectivity)
+        dialog.destroy()
+
     def font_callback(self, *whatever):
         dialog = Gtk.FontChooserDialog(_("Font"), self)
         dialog.props.preview_text = _("The quick brown fox jumps over the lazy dog.")
@@ -384,6 +700,9 @@ class Window(Gtk.ApplicationWindow):
     def menu_callback(self, *whatever):
         self.menu_button.set_active(not self.menu_button.get_active())
 
+    def message_response_callback(self, dialog, response):
+        dialog.destroy()
+
     def new_callback(self, *whatever):
         builder = Gtk.Builder()
         builder.set_translation_domain(package.get_name())
@@ -407,9 +726,25 @@ class Window(Gtk.ApplicationWindow):
             win.present()
         dialog.destroy()
 
+    def on_busy_changed(self, paintview):
+        if paintview.get_busy():
+            self.spinner.show()
+            self.spinner.start()
+        else:
+            self.spinner.stop()
+            self.spinner.hide()
+
     def on_delete_event(self, wid, event):
         return self.confirm_save_changes()
 
+    def on_destroy(self, wid):
+        if self.loading:
+            self.loading.cancel()
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        self.buffer.set_log(None)
+
     def on_key_press_event(self, wid, event):
         logger.debug("on_key_press: '%s', %08x", Gdk.keyval_name(event.keyval), event.state)
         if event.keyval in (Gdk.KEY_E, Gdk.KEY_e):
@@ -478,32 +813,166 @@ class Window(Gtk.ApplicationWindow):
     def paste_callback(self, *whatever):
         self.paintview.emit('paste-clipboard')
 
+    def record_operations_callback(self, action, parameter):
+        # Records the operations committed to the canvas to an operation log.
+        if action.get_state():
+            self.buffer.set_log(None)
+            action.set_state(GLib.Variant.new_boolean(False))
+            return
+        dialog = Gtk.FileChooserDialog(
+            _("Record Operations"), self,
+            Gtk.FileChooserAction.SAVE,
+            (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+             Gtk.STOCK_SAVE, Gtk.ResponseType.ACCEPT))
+        dialog.set_do_overwrite_confirmation(True)
+        self.initialize_file_chooser(dialog)
+        d = GLib.DateTime.new_now_local()
+        dialog.set_current_name(d.format("P_%Y%m%d_%H%M%S.oplog"))
+        response = dialog.run()
+        path = dialog.get_filename()
+        dialog.destroy()
+        if response != Gtk.ResponseType.ACCEPT or not path:
+            return
+        # The log starts from the canvas with the pending fill applied.
+        self.paintview.wait_fill()
+        try:
+            self.buffer.set_log(Recorder(path, self.buffer))
+        except OSError as e:
+            logger.error(e)
+            return
+        action.set_state(GLib.Variant.new_boolean(True))
+
     def redo_callback(self, *whatever):
         self.paintview.emit('redo')
 
-    def save(self):
+    def replay_undo_callback(self, action, parameter):
+        # Undo replays the tools from a checkpoint instead of keeping the
+        # pixels each tool has changed.
+        enable = not action.get_state()
+        action.set_state(GLib.Variant.new_boolean(enable))
+        self.buffer.set_history_mode(HISTORY_REPLAY if enable else HISTORY_DELTA)
+
+    def _encode(self, cancellable, file, stream, snapshot, generation):
+        # Runs in a worker thread. The replaced file appears only after the
+        # stream has been closed successfully.
         message = ''
+        surface, codec, options, background_color = snapshot
         try:
-            stream = GioStream(self.file, True)
-            self.paintview.reset()
-            self.buffer.write_to_png(stream)
+            start = time.perf_counter()
+            out = GioStream(file, True, stream)
+            codec.write(surface, out, background_color, **options)
+            out.close()
+            logger.debug("saved in %.3f sec", time.perf_counter() - start)
         except GLib.Error as e:
             message = e.message
         except Exception as e:
             message = str(e)
+        if message:
+            cancellable.cancel()
+            try:
+                stream.close(cancellable)
+            except GLib.Error:
+                pass
+        GLib.idle_add(self._on_saved, file, generation, message)
+
+    def _on_replace(self, file, result, data):
+        snapshot, generation = data
+        try:
+            stream = file.replace_finish(result)
+        except GLib.Error as e:
+            self._on_saved(file, generation, e.message)
+            return
+        thread = threading.Thread(target=self._encode,
+                                  args=(self.saving, file, stream, snapshot, generation),
+                                  daemon=True)
+        thread.start()
+
+    def _on_saved(self, file, generation, message):
+        self.saving = None
+        session = isinstance(find_codec(file.get_basename()), SessionCodec)
+        if message:
+            if session:
+                # The file may be left partially written.
+                self.buffer.set_session(None)
+            logger.error(message)
+            dialog = Gtk.MessageDialog(
+                self, 0, Gtk.MessageType.ERROR,
+                Gtk.ButtonsType.OK, _("Failed to save image."))
+            dialog.format_secondary_text(message)
+            dialog.run()
+            dialog.destroy()
+            self.save_as()
+            return GLib.SOURCE_REMOVE
+        if session:
+            current = self.buffer.get_session()
+            if not file.get_path():
+                self.buffer.set_session(None)
+            elif not current or current.path != file.get_path():
+                try:
+                    self.buffer.set_session(Session(file.get_path()))
+                except (OSError, ValueError) as e:
+                    logger.error(e)
+                    self.buffer.set_session(None)
+        if self.buffer.get_generation() == generation:
+            self.set_file(file)
+            self.journal.reset(file)
         else:
-            return self.set_file(self.file)
+            # Edited while saving
+            self.file = file
+            self.on_modified_changed(self.buffer)
+            self.journal.reset(file, True)
+        if self.close_after_save:
+            self.close_after_save = False
+            self.close_callback()
+        return GLib.SOURCE_REMOVE
+
+    def _write_back(self, file, snapshot, session, generation):
+        # Runs in a worker thread
+        message = ''
+        try:
+            start = time.perf_counter()
+            snapshot.write_back(session)
+            logger.debug("written back in %.3f sec", time.perf_counter() - start)
+        except OSError as e:
+            message = str(e)
+        GLib.idle_add(self._on_saved, file, generation, message)
 
-        dialog = Gtk.MessageDialog(
-            self, 0, Gtk.MessageType.ERROR,
-            Gtk.ButtonsType.OK, _("Failed to save image."))
-        dialog.format_secondary_text(message)
-        dialog.run()
-        dialog.destroy()
-        self.save_as()
+    def save(self):
+        # Saves a snapshot of the canvas in the background; the canvas can be
+        # edited meanwhile. Returns True as the changes are not saved yet.
+        if self.saving:
+            return True
+        self.paintview.reset()
+        self.paintview.wait_fill()
+        codec = find_codec(self.file.get_basename()) or get_codecs()[0]
+        options = {}
+        for option in codec.get_options():
+            options[option.name] = self.save_options.get(option.name, option.default)
+        if self.fast_save and codec.get_extension() == 'png':
+            options.update(FAST_SAVE)
+        if isinstance(codec, SessionCodec):
+            # Only the changed rows are written back to the session file.
+            surface = self.buffer.get_session_snapshot(self.file.get_path())
+            if surface.is_incremental():
+                self.saving = Gio.Cancellable()
+                thread = threading.Thread(target=self._write_back,
+                                          args=(self.file, surface, self.buffer.get_session(),
+                                                self.buffer.get_generation()),
+                                          daemon=True)
+                thread.start()
+                return True
+        else:
+            surface = self.buffer.get_snapshot()
+        snapshot = (surface, codec, options, self.buffer.get_background_color())
+        data = (snapshot, self.buffer.get_generation())
+        self.saving = Gio.Cancellable()
+        self.file.replace_async(None, False, Gio.FileCreateFlags.NONE, GLib.PRIORITY_DEFAULT,
+                                None, self._on_replace, data)
         return True
 
     def save_as(self):
+        if self.saving:
+            return True
         dialog = Gtk.FileChooserDialog(
             _("Save File"), self,
             Gtk.FileChooserAction.SAVE,
@@ -515,28 +984,45 @@ class Window(Gtk.ApplicationWindow):
             d = GLib.DateTime.new_now_local()
             name = d.format("P_%Y%m%d_%H%M%S.png")
             dialog.set_current_name(name)
-        dirty = True
-        while dirty:
-            dialog.hide()
-            dialog.show_all()
-            response = dialog.run()
-            if response == Gtk.ResponseType.ACCEPT:
-                self.file = dialog.get_file()
-                dirty = self.save()
-            else:
-                break
+        else:
+            name = self.file.get_basename()
+        filters = self.add_filters(dialog, True)
+        grid = Gtk.Grid(column_spacing=8, row_spacing=4)
+        dialog.set_extra_widget(grid)
+        codec = find_codec(name) or get_codecs()[0]
+        for filter_text, c in filters.items():
+            if c is codec:
+                dialog.set_filter(filter_text)
+        self.update_save_options(dialog, None, filters, grid)
+        dialog.connect("notify::filter", self.update_save_options, filters, grid)
+        response = dialog.run()
+        file = dialog.get_file()
         dialog.destroy()
-        return dirty
+        if response == Gtk.ResponseType.ACCEPT:
+            self.file = file
+            return self.save()
+        self.close_after_save = False
+        return True
 
     def save_as_callback(self, *whatever):
+        if self.loading or self.saving:
+            return
         self.save_as()
 
     def save_callback(self, *whatever):
+        if self.loading:
+            return
         if self.file:
             self.save()
         else:
             self.save_as()
 
+    def save_option_changed(self, widget, name):
+        if isinstance(widget, Gtk.ComboBox):
+            self.save_options[name] = widget.get_active()
+        else:
+            self.save_options[name] = widget.get_value_as_int()
+
     def select_all_callback(self, *whatever):
         self.paintview.emit('select-all', True)
 
@@ -592,7 +1078,52 @@ class Window(Gtk.ApplicationWindow):
     def transparent_selection_mode_callback(self, action, parameter):
         mode = not action.get_state()
         action.set_state(GLib.Variant.new_boolean(mode))
+        self.paintview.wait_fill()
         self.buffer.set_transparent_mode(mode)
 
+    def update_save_options(self, dialog, pspec, filters, grid):
+        # Shows the options of the codec selected in the save dialog.
+        codec = filters.get(dialog.get_filter())
+        if codec is None:
+            return
+        name = dialog.get_current_name()
+        if name and find_codec(name) is not codec:
+            if '.' in name:
+                name = name.rsplit('.', 1)[0]
+            dialog.set_current_name(name + '.' + codec.get_extension())
+        for child in grid.get_children():
+            grid.remove(child)
+        for row, option in enumerate(codec.get_options()):
+            grid.attach(Gtk.Label(label=option.label), 0, row, 1, 1)
+            value = self.save_options.get(option.name, option.default)
+            if option.choices:
+                widget = Gtk.ComboBoxText()
+                for choice in option.choices:
+                    widget.append_text(choice)
+                widget.set_active(value)
+                widget.connect("changed", self.save_option_changed, option.name)
+            else:
+                widget = Gtk.SpinButton.new_with_range(option.lower, option.upper, 1)
+                widget.set_value(value)
+                widget.connect("value-changed", self.save_option_changed, option.name)
+            grid.attach(widget, 1, row, 1, 1)
+        grid.show_all()
+
     def undo_callback(self, *whatever):
         self.paintview.emit('undo')
+
+    def undo_memory_callback(self, *whatever):
+        dialog = Gtk.Dialog(title=_("Undo Memory"), transient_for=self, modal=True, use_header_bar=True)
+        dialog.add_button(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        dialog.add_button(Gtk.STOCK_OK, Gtk.ResponseType.OK)
+        dialog.set_default_response(Gtk.ResponseType.OK)
+        scale = Gtk.Scale.new_with_range(Gtk.Orientation.HORIZONTAL, 16, 4096, 16)
+        scale.set_value(self.buffer.get_checkpoint_budget() / (1024 * 1024))
+        scale.set_digits(0)
+        scale.set_size_request(256, -1)
+        scale.set_tooltip_text(_('Megabytes of the checkpoints kept for undo by replaying'))
+        dialog.get_content_area().add(scale)
+        dialog.show_all()
+        if dialog.run() == Gtk.ResponseType.OK:
+            self.buffer.set_checkpoint_budget(int(scale.get_value()) * 1024 * 1024)
+        dialog.destroy()
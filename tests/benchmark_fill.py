@@ -0,0 +1,92 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares FloodFill, which fills in place on the surface memory, with the
+# old path, which converted a copy of the whole canvas to BGR and back.
+#
+#   python3 tests/benchmark_fill.py [size]
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from paint import HISTORY_REPLAY, FloodFill, PaintBuffer
+
+import cairo
+import cv2
+import math
+import numpy
+import time
+
+REPEAT = 5
+COLORS = ((1, 0, 0), (0, 0, 1))
+
+
+def create_canvas(size):
+    # A white canvas crossed by a few lines, so that a fill covers most of it.
+    buffer = PaintBuffer(size, size)
+    cr = cairo.Context(buffer.get_surface())
+    cr.set_source_rgb(0, 0, 0)
+    cr.set_line_width(4)
+    for i in range(1, 8):
+        cr.move_to(size * i / 8, 0)
+        cr.line_to(size * i / 8 + size / 16, size / 2)
+    cr.stroke()
+    buffer.get_surface().flush()
+    return buffer
+
+
+def fill_by_copy(buffer, x, y, color):
+    # The old path
+    surface = buffer.make_opaque(buffer.get_surface())
+    array = numpy.ndarray(shape=(surface.get_height(), surface.get_width(), 4),
+                          dtype=numpy.uint8, buffer=surface.get_data())
+    array = cv2.cvtColor(array, cv2.COLOR_RGBA2BGR)
+    cv2.floodFill(array, None, (x, y), [int(255 * i) for i in color])
+    array = cv2.cvtColor(array, cv2.COLOR_BGR2RGBA)
+    return cairo.ImageSurface.create_for_data(array, cairo.FORMAT_ARGB32,
+                                              surface.get_width(), surface.get_height())
+
+
+def fill_in_place(buffer, x, y, color):
+    tool = FloodFill(None)
+    tool.set_color(*color)
+    tool.on_mouse_release(None, None, x, y)
+    buffer.append(tool)
+
+
+def measure(fill, size):
+    buffer = create_canvas(size)
+    buffer.set_history_mode(HISTORY_REPLAY)
+    best = math.inf
+    for i in range(REPEAT):
+        start = time.perf_counter()
+        fill(buffer, size // 2, size - 1, COLORS[i % 2])
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(size):
+    in_place = measure(fill_in_place, size)
+    by_copy = measure(fill_by_copy, size)
+    print("%dx%d canvas: in place %.2f ms, convert and copy %.2f ms" %
+          (size, size, 1000 * in_place, 1000 * by_copy))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if 1 < len(sys.argv) else 8192))
@@ -0,0 +1,132 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares loading and saving a PNG image through GioStream, which maps or
+# reads the whole file and writes in large blocks, with reading and writing
+# a Gio stream a chunk at a time. Give the directories to test, e.g. a FUSE
+# mount such as ~/.gvfs or /run/user/1000/gvfs/..., or GIO URIs such as
+# sftp://host/tmp; the default is the temporary directory.
+#
+#   python3 tests/benchmark_io.py [directory or URI]... [--size size]
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from gi.repository import Gio
+
+from codec import read_png, write_png
+from window import LOAD_CHUNK, GioStream
+
+import argparse
+import cairo
+import math
+import tempfile
+import time
+
+REPEAT = 3
+
+
+class ChunkedStream:
+    # Reads and writes a Gio stream a chunk at a time.
+    def __init__(self, file, writable=False):
+        if writable:
+            self.stream = file.replace(None, False, Gio.FileCreateFlags.NONE, None)
+        else:
+            self.stream = file.read(None)
+        self.writable = writable
+
+    def close(self):
+        self.stream.close(None)
+
+    def read(self, size=-1):
+        chunks = []
+        while size < 0 or 0 < size:
+            b = self.stream.read_bytes(LOAD_CHUNK if size < 0 else min(size, LOAD_CHUNK), None)
+            if not b.get_size():
+                break
+            chunks.append(b.get_data())
+            if 0 < size:
+                size -= b.get_size()
+        return b''.join(chunks)
+
+    def write(self, b):
+        self.stream.write_all(bytes(b), None)
+        return len(b)
+
+
+def create_canvas(size):
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+    cr = cairo.Context(surface)
+    cr.set_source_rgb(1, 1, 1)
+    cr.paint()
+    cr.set_line_width(size / 256)
+    for i in range(64):
+        cr.set_source_rgb(i % 3 / 2, i % 5 / 4, i % 7 / 6)
+        cr.move_to(size / 2 + size / 3 * math.cos(i), size / 2 + size / 3 * math.sin(i))
+        cr.line_to(size / 2 + size / 3 * math.cos(3 * i), size / 2 + size / 3 * math.sin(2 * i))
+        cr.stroke()
+    surface.flush()
+    return surface
+
+
+def measure(function):
+    best = math.inf
+    for i in range(REPEAT):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return 1000 * best
+
+
+def save(stream, surface):
+    write_png(surface, stream)
+    stream.close()
+
+
+def load(stream):
+    read_png(stream)
+    stream.close()
+
+
+def run(location, surface):
+    directory = Gio.File.new_for_commandline_arg(location)
+    file = directory.get_child('benchmark_io.png')
+    try:
+        chunked_save = measure(lambda: save(ChunkedStream(file, True), surface))
+        bulk_save = measure(lambda: save(GioStream(file, True), surface))
+        chunked_load = measure(lambda: load(ChunkedStream(file)))
+        bulk_load = measure(lambda: load(GioStream(file)))
+    finally:
+        file.delete(None)
+    print("%s: save %.1f ms (chunked %.1f ms), load %.1f ms (chunked %.1f ms)" %
+          (location, bulk_save, chunked_save, bulk_load, chunked_load))
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('locations', nargs='*', default=[tempfile.gettempdir()])
+    parser.add_argument('--size', type=int, default=4096)
+    args = parser.parse_args(args)
+    surface = create_canvas(args.size)
+    for location in args.locations:
+        run(location, surface)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,94 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the encode time and the file size of write_png() at each filter
+# and compression level, and with FAST_SAVE, with cairo's write_to_png().
+#
+#   python3 tests/benchmark_png.py [size]
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from codec import (DEFAULT_COMPRESSION, FAST_SAVE, FILTER_ADAPTIVE, FILTER_AVERAGE, FILTER_NONE,
+                   FILTER_PAETH, FILTER_SUB, FILTER_UP, write_png)
+
+import cairo
+import io
+import math
+import time
+
+REPEAT = 3
+PRESETS = [
+    ("none", {'filter_type': FILTER_NONE}),
+    ("sub", {'filter_type': FILTER_SUB}),
+    ("up", {'filter_type': FILTER_UP}),
+    ("average", {'filter_type': FILTER_AVERAGE}),
+    ("paeth", {'filter_type': FILTER_PAETH}),
+    ("adaptive", {'filter_type': FILTER_ADAPTIVE}),
+    ("adaptive, level 1", {'compression': 1}),
+    ("adaptive, level 9", {'compression': 9}),
+    ("fast save", FAST_SAVE),
+]
+
+
+def create_canvas(size):
+    # A drawing of flat colors and a gradient, as painted with the tools.
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+    cr = cairo.Context(surface)
+    cr.set_source_rgb(1, 1, 1)
+    cr.paint()
+    gradient = cairo.LinearGradient(0, 0, size, size)
+    gradient.add_color_stop_rgb(0, 1, 0.8, 0.4)
+    gradient.add_color_stop_rgb(1, 0.2, 0.4, 1)
+    cr.set_source(gradient)
+    cr.rectangle(size / 4, size / 4, size / 2, size / 2)
+    cr.fill()
+    cr.set_line_width(size / 256)
+    for i in range(64):
+        cr.set_source_rgb(i % 3 / 2, i % 5 / 4, i % 7 / 6)
+        cr.move_to(size / 2 + size / 3 * math.cos(i), size / 2 + size / 3 * math.sin(i))
+        cr.line_to(size / 2 + size / 3 * math.cos(3 * i), size / 2 + size / 3 * math.sin(2 * i))
+        cr.stroke()
+    surface.flush()
+    return surface
+
+
+def measure(write):
+    best = math.inf
+    for i in range(REPEAT):
+        fobj = io.BytesIO()
+        start = time.perf_counter()
+        write(fobj)
+        best = min(best, time.perf_counter() - start)
+    return best, len(fobj.getvalue())
+
+
+def main(size):
+    surface = create_canvas(size)
+    print("%dx%d canvas" % (size, size))
+    seconds, length = measure(surface.write_to_png)
+    print("%-20s %8.1f ms %10d bytes" % ("cairo", 1000 * seconds, length))
+    for name, options in PRESETS:
+        options = dict({'compression': DEFAULT_COMPRESSION}, **options)
+        seconds, length = measure(lambda fobj: write_png(surface, fobj, **options))
+        print("%-20s %8.1f ms %10d bytes" % (name, 1000 * seconds, length))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if 1 < len(sys.argv) else 4096))
@@ -0,0 +1,70 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares redo in the replay mode, which draws only the redone tool, with
+# replaying the whole history, which redo used to cost.
+#
+#   python3 tests/benchmark_redo.py [depth]
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from paint import HISTORY_REPLAY, PaintBuffer, Pencil
+
+import math
+import time
+
+WIDTH = 2048
+HEIGHT = 2048
+REPEAT = 5
+
+
+def stroke(i):
+    tool = Pencil(None)
+    tool.set_line_width(1 + i % 8)
+    tool.set_color(i % 3 / 2, i % 5 / 4, i % 7 / 6)
+    cx = WIDTH / 2 + WIDTH / 3 * math.cos(i)
+    cy = HEIGHT / 2 + HEIGHT / 3 * math.sin(i)
+    tool.on_mouse_press(None, None, cx, cy)
+    for j in range(1, 64):
+        tool.on_mouse_move(None, None, cx + 4 * j * math.cos(i + j / 8), cy + 4 * j * math.sin(i + j / 8))
+    return tool
+
+
+def main(depth):
+    buffer = PaintBuffer(WIDTH, HEIGHT)
+    buffer.set_history_mode(HISTORY_REPLAY)
+    for i in range(depth):
+        buffer.append(stroke(i))
+    redo = replay = math.inf
+    for i in range(REPEAT):
+        buffer.do_undo()
+        start = time.perf_counter()
+        buffer.do_redo()
+        redo = min(redo, time.perf_counter() - start)
+        start = time.perf_counter()
+        if not buffer._verify():
+            print("redo does not match the replayed history", file=sys.stderr)
+            return 1
+        replay = min(replay, time.perf_counter() - start)
+    print("%d tools: redo %.2f ms, full replay %.2f ms" % (depth, 1000 * redo, 1000 * replay))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if 1 < len(sys.argv) else 200))
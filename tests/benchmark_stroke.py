@@ -0,0 +1,68 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Times the frames of a Pencil stroke in progress on a large canvas: the
+# first frame, which allocates the stroke layer, and the rest, which draw
+# the new segments only.
+#
+#   python3 tests/benchmark_stroke.py [size]
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from paint import PaintBuffer, Pencil
+
+import cairo
+import math
+import time
+
+VIEW_WIDTH = 1920
+VIEW_HEIGHT = 1080
+FRAMES = 600
+POINTS_PER_FRAME = 4
+
+
+def main(size):
+    buffer = PaintBuffer(size, size)
+    view = cairo.ImageSurface(cairo.FORMAT_ARGB32, VIEW_WIDTH, VIEW_HEIGHT)
+    tool = Pencil(None)
+    tool.set_line_width(8)
+    tool.on_mouse_press(None, None, VIEW_WIDTH / 2, VIEW_HEIGHT / 2)
+    times = []
+    for frame in range(FRAMES):
+        points = []
+        for i in range(POINTS_PER_FRAME):
+            t = (frame * POINTS_PER_FRAME + i) / 50
+            points.append((VIEW_WIDTH / 2 + 8 * t * math.cos(t), VIEW_HEIGHT / 2 + 8 * t * math.sin(t)))
+        start = time.perf_counter()
+        tool.on_mouse_motion(None, None, points)
+        cr = cairo.Context(view)
+        cr.rectangle(*tool.get_damage(buffer))
+        cr.clip()
+        buffer.draw(cr)
+        tool.on_draw(cr, buffer)
+        view.flush()
+        times.append(time.perf_counter() - start)
+    print("%dx%d canvas: first frame %.2f ms, frames %.2f ms on average, %.2f ms at most; layer %dx%d" %
+          (size, size, 1000 * times[0], 1000 * sum(times[1:]) / (len(times) - 1), 1000 * max(times[1:]),
+           tool.layer_rect[2], tool.layer_rect[3]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if 1 < len(sys.argv) else 8192))
@@ -0,0 +1,54 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import batch
+from paint import get_argb32
+
+import cairo
+import json
+import pytest
+
+WIDTH = 32
+HEIGHT = 32
+
+
+def test_batch(tmp_path, monkeypatch):
+    src = tmp_path / 'in.png'
+    dst = tmp_path / 'out.png'
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, WIDTH, HEIGHT)
+    cr = cairo.Context(surface)
+    cr.set_source_rgb(1, 1, 1)
+    cr.paint()
+    surface.write_to_png(str(src))
+    path = tmp_path / 'ops.json'
+    path.write_text(json.dumps([
+        {'tool': 'floodfill', 'points': [[1, 1]], 'color': [1, 0, 0]},
+        {'tool': 'line', 'points': [[0, 16], [31, 16]], 'color': [0, 0, 1], 'width': 4, 'antialias': False},
+    ]))
+    monkeypatch.setattr(batch, 'operations', batch.load_operations(str(path)))
+    monkeypatch.setattr(batch, 'font', 'Sans 12')
+    assert batch._process((str(src), str(dst))) == ''
+    pixels = get_argb32(cairo.ImageSurface.create_from_png(str(dst)))
+    assert pixels[4, 4] == 0xffff0000
+    assert pixels[16, 8] == 0xff0000ff
+    assert pixels[28, 28] == 0xffff0000
+
+
+def test_load_operations(tmp_path):
+    path = tmp_path / 'ops.json'
+    path.write_text(json.dumps([{'tool': 'lasso', 'points': [[0, 0]]}]))
+    with pytest.raises(ValueError):
+        batch.load_operations(str(path))
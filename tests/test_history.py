@@ -0,0 +1,138 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from history import HistoryStore
+from paint import HISTORY_DELTA, HISTORY_REPLAY, Line, PaintBuffer
+from session import Snapshot
+
+import cairo
+
+WIDTH = 128
+HEIGHT = 96
+
+
+def line(i):
+    tool = Line(None)
+    tool.set_color(i % 3 / 2, i % 5 / 4, i % 7 / 6)
+    tool.set_line_width(1 + i % 4)
+    tool.x = 7 * i % WIDTH
+    tool.y = 11 * i % HEIGHT
+    tool.width = 13 * i % WIDTH - tool.x
+    tool.height = HEIGHT - 1 - tool.y
+    return tool
+
+
+def pixels(buffer):
+    return buffer.get_pixels().tobytes()
+
+
+def test_replay_undo_matches_delta():
+    replay = PaintBuffer(WIDTH, HEIGHT)
+    replay.set_history_mode(HISTORY_REPLAY)
+    delta = PaintBuffer(WIDTH, HEIGHT)
+    delta.set_history_mode(HISTORY_DELTA)
+    for i in range(40):
+        replay.append(line(i))
+        delta.append(line(i))
+    assert replay.checkpoints
+    for i in range(25):
+        replay.do_undo()
+        delta.do_undo()
+        assert pixels(replay) == pixels(delta)
+    for i in range(10):
+        replay.do_redo()
+        delta.do_redo()
+        assert pixels(replay) == pixels(delta)
+
+
+def test_checkpoint_budget():
+    buffer = PaintBuffer(WIDTH, HEIGHT)
+    original = pixels(buffer)
+    buffer.set_history_mode(HISTORY_REPLAY)
+    size = buffer.get_surface().get_stride() * HEIGHT
+    buffer.set_checkpoint_budget(2 * size)
+    for i in range(100):
+        buffer.append(line(i))
+    assert 1 <= len(buffer.checkpoints)
+    assert buffer.get_checkpoint_size() <= buffer.get_checkpoint_budget()
+    buffer.set_checkpoint_budget(0)
+    # The latest checkpoint is always kept.
+    assert len(buffer.checkpoints) == 1
+    while buffer.undo:
+        buffer.do_undo()
+    assert pixels(buffer) == original
+
+
+def test_redo_matches_full_replay():
+    buffer = PaintBuffer(WIDTH, HEIGHT)
+    buffer.set_history_mode(HISTORY_REPLAY)
+    for i in range(40):
+        buffer.append(line(i))
+    for i in range(30):
+        buffer.do_undo()
+    for i in range(30):
+        buffer.do_redo()
+        assert buffer._verify()
+
+
+def test_replay_undo_keeps_saved_depth(tmp_path):
+    # A buffer with a session keeps its history when it is saved.
+    path = str(tmp_path / 'image.epaint')
+    with open(path, 'wb') as f:
+        Snapshot(WIDTH, HEIGHT, PaintBuffer(WIDTH, HEIGHT).get_surface()).write(f)
+    buffer = PaintBuffer.create_from_session(path)
+    buffer.set_history_mode(HISTORY_REPLAY)
+    for i in range(5):
+        buffer.append(line(i))
+    buffer.set_modified(False)
+    saved = pixels(buffer)
+    for i in range(3):
+        buffer.do_undo()
+        assert buffer.get_modified()
+    for i in range(3):
+        buffer.do_redo()
+    assert not buffer.get_modified()
+    assert pixels(buffer) == saved
+
+
+def surface(i):
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, WIDTH, HEIGHT)
+    cr = cairo.Context(surface)
+    cr.set_source_rgb(i % 3 / 2, i % 5 / 4, i % 7 / 6)
+    cr.paint()
+    cr.set_source_rgb(1 - i % 3 / 2, 1, 0)
+    cr.rectangle(i, i, WIDTH / 2, HEIGHT / 2)
+    cr.fill()
+    surface.flush()
+    return surface
+
+
+def test_journal_compaction():
+    # Every entry is spilled to the journal.
+    store = HistoryStore(budget=0, raw=0, slack=1)
+    entries = [store.put(surface(i)) for i in range(10)]
+    assert all(0 <= entry.offset for entry in entries)
+    size = store.get_disk_usage()
+    for i, entry in enumerate(entries[:8], 1):
+        store.discard(entry)
+        # At most half of the journal is left for the discarded entries.
+        assert store.get_disk_usage() <= 2 * sum(e.length for e in entries[i:])
+    assert store.get_disk_usage() < size
+    for i, entry in enumerate(entries[8:], 8):
+        assert bytes(store.get(entry).get_data()) == bytes(surface(i).get_data())
+    for entry in entries[8:]:
+        store.discard(entry)
+    assert store.get_disk_usage() == 0
@@ -0,0 +1,62 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from oplog import Recorder, replay
+from paint import Line, PaintBuffer
+
+WIDTH = 128
+HEIGHT = 96
+
+
+def line(i):
+    tool = Line(None)
+    tool.set_color(i % 3 / 2, i % 5 / 4, i % 7 / 6)
+    tool.set_line_width(1 + i % 4)
+    tool.x = 7 * i % WIDTH
+    tool.y = 11 * i % HEIGHT
+    tool.width = 13 * i % WIDTH - tool.x
+    tool.height = HEIGHT - 1 - tool.y
+    return tool
+
+
+def pixels(buffer):
+    return buffer.get_pixels().tobytes()
+
+
+def test_replay_after_undo_past_start(tmp_path):
+    buffer = PaintBuffer(WIDTH, HEIGHT)
+    for i in range(4):
+        buffer.append(line(i))
+    buffer.do_undo()
+    path = str(tmp_path / 'test.oplog')
+    buffer.set_log(Recorder(path, buffer))
+    # Undo and redo stop at the canvas the log starts from.
+    buffer.do_redo()
+    buffer.append(line(4))
+    for i in range(3):
+        buffer.do_undo()
+    assert len(buffer.undo) == 3
+    buffer.append(line(5))
+    buffer.do_undo()
+    buffer.do_redo()
+    buffer.set_log(None)
+    replayed, count = replay(path)
+    assert count == 5
+    assert pixels(replayed) == pixels(buffer)
+    # The history before the log is kept.
+    buffer.do_undo()
+    buffer.do_undo()
+    assert len(buffer.undo) == 2
@@ -0,0 +1,151 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from paint import HISTORY_DELTA, HISTORY_REPLAY, FloodFill, PaintBuffer, Pencil, Rectangle, get_argb32
+
+import cairo
+import io
+import numpy
+
+WIDTH = 128
+HEIGHT = 96
+
+WHITE = 0xffffffff
+GRAY = 0xff808080
+RED = 0xffff0000
+
+
+def create_buffer(pixels):
+    # Returns a PaintBuffer of pixels, a numpy array of ARGB32 values.
+    height, width = pixels.shape
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    get_argb32(surface)[...] = pixels
+    surface.mark_dirty()
+    fobj = io.BytesIO()
+    surface.write_to_png(fobj)
+    fobj.seek(0)
+    return PaintBuffer.create_from_png(fobj)
+
+
+def create_canvas():
+    # A gray square with a pixel close to gray, a pixel farther from gray,
+    # and a gray pixel touching the square only diagonally.
+    pixels = numpy.full((32, 32), WHITE, dtype=numpy.uint32)
+    pixels[4:13, 4:13] = GRAY
+    pixels[8, 8] = 0xff848484
+    pixels[6, 6] = 0xff909090
+    pixels[13, 13] = GRAY
+    return pixels
+
+
+def fill(x, y, tolerance, connectivity):
+    tool = FloodFill(None)
+    tool.set_color(1, 0, 0)
+    tool.set_fill_mode(tolerance, connectivity)
+    tool.on_mouse_release(None, None, x, y)
+    return tool
+
+
+def contains(rect, point):
+    x, y, width, height = rect
+    return x <= point[0] <= x + width and y <= point[1] <= y + height
+
+
+def test_pencil_damage_covers_batched_points():
+    buffer = PaintBuffer(WIDTH, HEIGHT)
+    tool = Pencil(None)
+    tool.on_mouse_press(None, None, 10, 10)
+    tool.on_mouse_motion(None, None, [(12, 10), (14, 12), (16, 15), (18, 19), (20, 24)])
+    tool.get_damage(buffer)
+    last = tool.stroke[-1]
+    count = len(tool.control_points)
+    # A fast stroke moves far in one frame.
+    points = [(24 + 10 * i, 30 + 7 * i) for i in range(8)]
+    tool.on_mouse_motion(None, None, points)
+    damage = tool.get_damage(buffer)
+    for point in [last] + points + tool.control_points[count - 1:]:
+        assert contains(damage, point)
+
+
+def test_fill_tolerance_and_connectivity():
+    buffer = create_buffer(create_canvas())
+    buffer.append(fill(5, 5, 8, 8))
+    pixels = get_argb32(buffer.get_surface())
+    assert pixels[5, 5] == RED
+    assert pixels[8, 8] == RED     # within the tolerance
+    assert pixels[6, 6] == 0xff909090
+    assert pixels[13, 13] == RED   # 8-way
+    assert pixels[0, 0] == WHITE
+
+    buffer = create_buffer(create_canvas())
+    buffer.append(fill(5, 5, 8, 4))
+    pixels = get_argb32(buffer.get_surface())
+    assert pixels[8, 8] == RED
+    assert pixels[13, 13] == GRAY
+
+
+def test_fill_replay_matches_fresh_fill():
+    canvas = create_canvas()
+    expected = create_buffer(canvas)
+    expected.append(fill(5, 5, 8, 8))
+    expected = get_argb32(expected.get_surface()).copy()
+
+    # Undo rebuilds the canvas replaying the fill from its packed mask.
+    buffer = create_buffer(canvas)
+    buffer.set_history_mode(HISTORY_REPLAY)
+    tool = fill(5, 5, 8, 8)
+    buffer.append(tool)
+    assert tool.bits is not None
+    rectangle = Rectangle(None)
+    rectangle.set_line_width(4)
+    rectangle.x, rectangle.y, rectangle.width, rectangle.height = 2, 2, 20, 20
+    buffer.append(rectangle)
+    buffer.do_undo()
+    assert (get_argb32(buffer.get_surface()) == expected).all()
+
+    # Replaying over a changed canvas fills the same pixels rather than
+    # searching them again.
+    changed = canvas.copy()
+    changed[13, 5] = GRAY
+    buffer = create_buffer(changed)
+    buffer.append(tool)
+    pixels = get_argb32(buffer.get_surface())
+    assert pixels[13, 5] == GRAY
+    expected[13, 5] = GRAY
+    assert (pixels == expected).all()
+
+
+def test_modify_pixels_can_be_undone():
+    for mode in (HISTORY_DELTA, HISTORY_REPLAY):
+        buffer = PaintBuffer(WIDTH, HEIGHT)
+        buffer.set_history_mode(mode)
+        original = get_argb32(buffer.get_surface()).copy()
+        with buffer.modify_pixels((8, 8, 16, 16)) as pixels:
+            pixels.view(numpy.uint32)[..., 0] = RED
+        modified = get_argb32(buffer.get_surface()).copy()
+        assert modified[8, 8] == RED and modified[24, 24] == WHITE
+        assert buffer.get_modified()
+        rectangle = Rectangle(None)
+        rectangle.x, rectangle.y, rectangle.width, rectangle.height = 4, 4, 40, 40
+        buffer.append(rectangle)
+        # In the replay mode, the modified pixels are redrawn from the
+        # Restored tool.
+        buffer.do_undo()
+        assert (get_argb32(buffer.get_surface()) == modified).all()
+        buffer.do_undo()
+        assert (get_argb32(buffer.get_surface()) == original).all()
+        buffer.do_redo()
+        assert (get_argb32(buffer.get_surface()) == modified).all()
@@ -0,0 +1,56 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from recovery import DELTA, MAGIC, RECORD, _read, recover
+
+import io
+import json
+import struct
+import zlib
+
+
+def record(i):
+    data = zlib.compress(bytes([i]) * 16)
+    return RECORD.pack(DELTA, 0, 255, 255, 255, i, i, 2, 2, len(data), zlib.crc32(data)) + data
+
+
+def test_read_stops_at_torn_record():
+    header = json.dumps({'width': 8, 'height': 8}).encode()
+    journal = MAGIC + struct.pack('>I', len(header)) + header + record(1) + record(2)
+    f = io.BytesIO(journal + record(3)[:-1])
+    header, records, end = _read(f)
+    assert header['width'] == 8
+    assert [rect for mode, rgb, rect, data in records] == [(1, 1, 2, 2), (2, 2, 2, 2)]
+    assert end == len(journal)
+
+    # A record appended after truncating the torn one can be recovered.
+    f.truncate(end)
+    f.seek(end)
+    f.write(record(3))
+    assert len(_read(f)[1]) == 3
+
+
+def test_recover_without_base(tmp_path):
+    # The file the journal starts from is gone; the image is recovered as
+    # an untitled one.
+    header = json.dumps({'uri': (tmp_path / 'missing.png').as_uri(), 'size': 1, 'mtime': 1,
+                         'width': 8, 'height': 8, 'transparent_mode': False}).encode()
+    path = tmp_path / 'test.journal'
+    path.write_bytes(MAGIC + struct.pack('>I', len(header)) + header + record(1))
+    buffer, file = recover(str(path))
+    assert file is None
+    assert (buffer.get_width(), buffer.get_height()) == (8, 8)
+    assert buffer.get_pixels((1, 1, 2, 2)).tobytes() == bytes([1]) * 16
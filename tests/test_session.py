@@ -0,0 +1,84 @@
+# Paint
+#
+# Copyright (c) 2024 Esrille Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from session import SLOT_SIZE, Session, SessionCodec, Snapshot
+
+import cairo
+import pytest
+
+WIDTH = 64
+HEIGHT = 48
+
+
+def surface(value):
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, WIDTH, HEIGHT)
+    surface.get_data()[:] = bytes([value]) * len(surface.get_data())
+    surface.mark_dirty()
+    return surface
+
+
+def pixels(session):
+    return bytes(session.map().get_data())
+
+
+def write_back(session, value, start, stop):
+    stride = session.stride
+    rows = bytes([value]) * ((stop - start) * stride)
+    Snapshot(WIDTH, HEIGHT, rows, start=start).write_back(session)
+    return rows
+
+
+def test_write_back(tmp_path):
+    path = str(tmp_path / 'image.epaint')
+    with open(path, 'wb') as f:
+        Snapshot(WIDTH, HEIGHT, surface(0x11)).write(f)
+    session = Session(path)
+    stride = session.stride
+    expected = bytearray(pixels(session))
+    for i, (start, stop) in enumerate(((4, 8), (0, 2), (40, 48))):
+        expected[start * stride:stop * stride] = write_back(session, 0x20 + i, start, stop)
+        assert pixels(Session(path)) == expected
+    with open(path, 'rb') as f:
+        assert bytes(SessionCodec().read(f).get_data()) == expected
+
+
+def test_crash_while_writing_back(tmp_path):
+    path = str(tmp_path / 'image.epaint')
+    with open(path, 'wb') as f:
+        Snapshot(WIDTH, HEIGHT, surface(0x11)).write(f)
+    session = Session(path)
+    stride = session.stride
+    expected = bytearray(pixels(session))
+
+    # Crash after the journal has been committed.
+    def crash(start, stop):
+        raise OSError('crash')
+    session.pin = crash
+    with pytest.raises(OSError):
+        write_back(session, 0x33, 8, 16)
+    expected[8 * stride:16 * stride] = bytes([0x33]) * (8 * stride)
+    with open(path, 'rb') as f:
+        assert bytes(SessionCodec().read(f).get_data()) == expected
+    session = Session(path)
+    assert session.journal is None
+    assert pixels(session) == expected
+
+    # A torn header is ignored in favor of the other slot.
+    generation = session.generation
+    with open(path, 'r+b') as f:
+        f.seek(generation % 2 * SLOT_SIZE + 16)
+        f.write(b'\xff')
+    assert pixels(Session(path)) == expected